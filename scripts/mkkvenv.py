@@ -5,13 +5,23 @@
 import yaml
 
 import argparse
+import codecs
 import copy
+import functools
+import http.client
 import json
 import logging
+import math
+import os
+import random
+import socket
+import ssl
 import subprocess
 import sys
+import threading
 import time
 import urllib.error
+import urllib.parse
 import urllib.request
 
 
@@ -21,7 +31,15 @@ def _configure():
     parser.add_argument("-N", "--instances", type=int, default=1,
                         help="number of VMs to run")
     parser.add_argument("-c", "--command", type=str, default="kubectl",
-                        help="command to use to control the cluster")
+                        help="command to use to control the cluster, or URL"
+                        " of the API server (e.g. 'http://127.0.0.1:8001'"
+                        " from 'kubectl proxy') to talk to it directly;"
+                        " the bearer token, if any, is read from"
+                        " $BENCHKIT_API_TOKEN")
+    parser.add_argument("-n", "--namespace", type=str, default=None,
+                        help="namespace to work in (default: the current"
+                        " namespace of kubectl, or 'default' when talking"
+                        " to the API server directly)")
     parser.add_argument("-S", "--setup-only", action="store_true",
                         help="stop after the setup step")
     parser.add_argument("-T", "--teardown-only", action="store_true",
@@ -38,6 +56,26 @@ def _configure():
                         help="HTTP endpoint to fetch the image to import")
     parser.add_argument("-H", "--hosts-file", type=str, default="hosts",
                         help="save hosts information here ('-' for stdout)")
+    parser.add_argument("-B", "--bulk", action="store_true",
+                        help="provision the PVCs, create, start and delete"
+                        " all the VMs at once, not one by one")
+    parser.add_argument("-W", "--watch", action="store_true",
+                        help="watch the cluster objects to track readiness,"
+                        " instead of polling them")
+    parser.add_argument("-G", "--golden-pvc", type=str, default=None,
+                        help="import the image once in this PVC, and"
+                        " provision the PVCs of the VMs cloning it")
+    parser.add_argument("--golden-namespace", type=str, default=None,
+                        help="namespace of the golden PVC, e.g. to share it"
+                        " across namespaces; needs the permission to clone"
+                        " from it (default: the namespace of the VMs)")
+    parser.add_argument("-p", "--pool", type=str, default=None,
+                        help="keep the VMs running in the warm pool with"
+                        " this name: add or remove only the VMs needed to"
+                        " have --instances VMs, write the hosts file, and"
+                        " exit. Use --teardown-only to remove the pool")
+    parser.add_argument("-D", "--delete-pvcs", action="store_true",
+                        help="on teardown, delete the PVCs of the VMs too")
     parser.add_argument("spec")
 
     return parser.parse_args(sys.argv[1:])
@@ -62,6 +100,37 @@ spec:
 """
 #TODO figure out size
 
+_DEFAULT_IMAGE_SIZE = 10  # Gi
+
+_WATCH_CHUNK = 64 * 1024  # bytes
+
+_IMPORT_ANNOTATIONS = (
+    "cdi.kubevirt.io/storage.import.endpoint",
+    "cdi.kubevirt.io/storage.import.secretName",
+)
+_IMPORT_PHASE = "cdi.kubevirt.io/storage.import.pod.phase"
+_CLONE_REQUEST = "k8s.io/CloneRequest"
+_CLONE_OF = "k8s.io/CloneOf"
+_CLONE_PHASE = "cdi.kubevirt.io/storage.clone.pod.phase"
+
+# marks the VMs of a warm pool, kept running across runs
+_POOL_LABEL = "benchkit.io/pool"
+_LAUNCHER_SELECTOR = "kubevirt.io=virt-launcher"
+_LAUNCHER_PREFIX = "virt-launcher-"
+_DOMAIN_LABEL = "kubevirt.io/domain"
+
+_KUBEVIRT_API = "kubevirt.io/v1alpha2"
+_API_PREFIXES = ("http://", "https://")
+_API_TIMEOUT = 30  # seconds
+
+# libyaml bindings are much faster, when available
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# stamped with the actual values in the serialized VM template
+_NAME_MARK = "__benchkit_name__"
+_CLAIM_MARK = "__benchkit_claim__"
+
 
 def customize(vm_master_def, ident):
     vm_def = copy.deepcopy(vm_master_def)
@@ -78,8 +147,11 @@ class KubeEntity:
     def name(self):
         return self._def['metadata']['name']
 
+    def to_dict(self):
+        return self._def
+
     def to_yaml(self):
-        return yaml.dump(self._def)
+        return yaml.dump(self._def, Dumper=_YAML_DUMPER)
 
     def to_bytes(self):
         return self.to_yaml().encode('utf-8')
@@ -89,20 +161,19 @@ class VMDef(KubeEntity):
 
     kind = "VirtualMachine"
 
-    def __init__(self, master_def, ident=None):
-        self._def = copy.deepcopy(master_def)
-        if ident is not None:
-            self._def['metadata']['name'] = '%s-%i' % (
-                self._def['metadata']['name'],
-                ident
-            )
-            rootvol = self.rootvolume()
-            if rootvol is not None:
-                rootvol.rename_claim("%s-%i" % (
-                        rootvol.claim_name,
-                        ident
-                    )
-                )
+    def __init__(self, master_def, ident=None, template=None):
+        # template: VMTemplate of master_def, to serialize faster
+        self._template = None
+        if ident is None:
+            self._def = copy.deepcopy(master_def)
+            return
+        name = '%s-%i' % (master_def['metadata']['name'], ident)
+        claim = _root_claim(master_def)
+        if claim is not None:
+            claim = '%s-%i' % (claim, ident)
+        # shares with master_def all but the fields changed here
+        self._def = _instance_def(master_def, name, claim)
+        self._template = template
 
     @property
     def volumes(self):
@@ -117,6 +188,62 @@ class VMDef(KubeEntity):
                 return vol
         return None
 
+    def to_yaml(self):
+        if self._template is None:
+            return super().to_yaml()
+        rootvol = self.rootvolume()
+        return self._template.render(
+            self.name, None if rootvol is None else rootvol.claim_name)
+
+
+def _root_claim(vm_def):
+    for vol in vm_def["spec"]["template"]["spec"]["volumes"]:
+        vol = Volume(vol)
+        if vol.is_root:
+            return vol.claim_name
+    return None
+
+
+def _instance_def(master_def, name, claim):
+    vm_def = dict(master_def)
+    vm_def["metadata"] = dict(master_def["metadata"], name=name)
+    if claim is None:
+        return vm_def
+    spec = vm_def["spec"] = dict(master_def["spec"])
+    template = spec["template"] = dict(spec["template"])
+    template_spec = template["spec"] = dict(template["spec"])
+    volumes = template_spec["volumes"] = list(template_spec["volumes"])
+    for index, vol in enumerate(volumes):
+        if Volume(vol).is_root and Volume(vol).claim_name is not None:
+            vol = volumes[index] = dict(vol)
+            vol["persistentVolumeClaim"] = dict(
+                vol["persistentVolumeClaim"], claimName=claim)
+    return vm_def
+
+
+class VMTemplate:
+    # serializes the master definition once, then stamps name and claim
+    def __init__(self, master_def):
+        claim = _root_claim(master_def)
+        self._text = yaml.dump(
+            _instance_def(master_def, _NAME_MARK,
+                          None if claim is None else _CLAIM_MARK),
+            Dumper=_YAML_DUMPER)
+
+    def render(self, name, claim=None):
+        # quoted, so any name is a string
+        text = self._text.replace(_NAME_MARK, json.dumps(name))
+        if claim is not None:
+            text = text.replace(_CLAIM_MARK, json.dumps(claim))
+        return text
+
+
+def make_vm_defs(master_def, instances):
+    template = VMTemplate(master_def)
+    return [
+        VMDef(master_def, ident, template) for ident in range(instances)
+    ]
+
 
 class Volume:
     def __init__(self, vol_def):
@@ -150,7 +277,7 @@ class PVC(KubeEntity):
 
     @classmethod
     def from_yaml(cls, data):
-        return cls(yaml.load(data))
+        return cls(yaml.load(data, Loader=_YAML_LOADER))
 
     def __init__(self, pvc_def):
         self._def = pvc_def
@@ -161,13 +288,27 @@ class PVC(KubeEntity):
 
         self._def["metadata"]["annotations"].update(notes)
 
+    def clone_from(self, namespace, name):
+        notes = self._def["metadata"].setdefault("annotations", {})
+        for note in _IMPORT_ANNOTATIONS:
+            notes.pop(note, None)
+        notes[_CLONE_REQUEST] = "%s/%s" % (namespace, name)
+
     @property
     def import_phase(self):
         notes = self._def["metadata"].get("annotations", {})
-        return notes.get(
-            "cdi.kubevirt.io/storage.import.pod.phase",
-            None
-        )
+        return notes.get(_IMPORT_PHASE, None)
+
+    @property
+    def clone_phase(self):
+        notes = self._def["metadata"].get("annotations", {})
+        if notes.get(_CLONE_OF) == "true":
+            return "Succeeded"
+        return notes.get(_CLONE_PHASE, None)
+
+    @property
+    def ready(self):
+        return "Succeeded" in (self.import_phase, self.clone_phase)
 
 
 class POD(KubeEntity):
@@ -175,7 +316,21 @@ class POD(KubeEntity):
         self._def = pod_def
 
     def related_to(self, vm_def):
-        return vm_def.name in self.name
+        return self.domain == vm_def.name
+
+    @property
+    def domain(self):
+        labels = self._def["metadata"].get("labels", {})
+        if _DOMAIN_LABEL in labels:
+            return labels[_DOMAIN_LABEL]
+        # older KubeVirt: virt-launcher-$DOMAIN-$SUFFIX
+        if self.name.startswith(_LAUNCHER_PREFIX):
+            return self.name[len(_LAUNCHER_PREFIX):].rpartition('-')[0]
+        return None
+
+    @property
+    def terminating(self):
+        return "deletionTimestamp" in self._def["metadata"]
 
     @property
     def ip(self):
@@ -197,15 +352,249 @@ class POD(KubeEntity):
         return self._def["status"]["phase"]
 
 
+def split_json(buf):
+    # splits a stream of concatenated JSON objects, like the one
+    # 'kubectl get --watch -o json' emits. Returns the complete objects
+    # and the incomplete trailing data, if any.
+    decoder = json.JSONDecoder()
+    objs, pos = [], 0
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            break
+        try:
+            obj, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            break  # incomplete, needs more data
+        objs.append(obj)
+    return objs, buf[pos:]
+
+
+def index_pods(pods):
+    ret = {}
+    for pod in pods:
+        if pod.domain is None:
+            continue
+        if pod.terminating and pod.domain in ret:
+            continue  # a replacement pod is already there
+        ret[pod.domain] = pod
+    return ret
+
+
+class Watcher:
+    def __init__(self, args, make_entity, proc=None, cond=None):
+        # proc: already started source, with the Popen interface
+        # cond: shared with other watchers, to wait for any of them
+        self._make_entity = make_entity
+        self._cond = threading.Condition() if cond is None else cond
+        self._items = {}
+        self._deleted = {}
+        self._changes = 0
+        self._done = False
+        if proc is None:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self._proc = proc
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self):
+        with self._cond:
+            return not self._done
+
+    @property
+    def started(self):
+        # once the first event arrived, no deletion goes unnoticed
+        with self._cond:
+            return self._changes > 0
+
+    def snapshot(self):
+        with self._cond:
+            return set(self._items.values())
+
+    def deleted(self):
+        # the objects seen going away, needs the DELETED events
+        with self._cond:
+            return set(self._deleted.values())
+
+    def wait_changed(self, timeout):
+        return Watcher.wait_any([self], timeout)
+
+    @staticmethod
+    def wait_any(watchers, timeout):
+        # the watchers must share their condition
+        cond = watchers[0]._cond
+        with cond:
+            changes = [watcher._changes for watcher in watchers]
+            return cond.wait_for(
+                lambda: any(
+                    watcher._changes != seen or watcher._done
+                    for watcher, seen in zip(watchers, changes)),
+                timeout)
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.terminate()
+        self._proc.wait()
+        self._reader.join()
+
+    def _read(self):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        buf = ''
+        try:
+            for chunk in iter(
+                    lambda: self._proc.stdout.read1(_WATCH_CHUNK), b''):
+                buf += decoder.decode(chunk)
+                objs, buf = split_json(buf)
+                if objs:
+                    self._update(objs)
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _update(self, objs):
+        with self._cond:
+            for obj in objs:
+                event = None
+                if "object" in obj and "type" in obj:
+                    # --output-watch-events
+                    event, obj = obj["type"], obj["object"]
+                entity = self._make_entity(obj)
+                if event == "DELETED":
+                    self._items.pop(entity.name, None)
+                    self._deleted[entity.name] = entity
+                else:
+                    self._items[entity.name] = entity
+            self._changes += 1
+            self._cond.notify_all()
+
+
+def _start_watch(watch):
+    try:
+        return watch()
+    except (OSError, RuntimeError) as exc:
+        logging.warning("cannot watch (%s), polling", exc)
+        return None
+
+
+def _watching(watcher):
+    return watcher is not None and watcher.alive
+
+
+def _pause(watcher, step):
+    # returns the seconds actually waited
+    return _pause_any([watcher], step)
+
+
+def _pause_any(watchers, step):
+    # wakes up on the first change of any watcher
+    live = [watcher for watcher in watchers if _watching(watcher)]
+    if live:
+        begin = time.monotonic()
+        Watcher.wait_any(live, step)
+        return time.monotonic() - begin
+    time.sleep(step)
+    return step
+
+
+class Deadline:
+    # monotonic: the time spent listing counts as well
+    def __init__(self, timeout):
+        self._begin = time.monotonic()
+        self._timeout = timeout
+
+    def elapsed(self):
+        return time.monotonic() - self._begin
+
+    def remaining(self):
+        return max(0., self._timeout - self.elapsed())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class Backoff:
+    # polling interval: grows while nothing changes, shrinks on progress
+    # and when few objects are left, jittered not to poll in lockstep
+    def __init__(self, initial, minimum, maximum, factor=1.5, jitter=0.2):
+        self._interval = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._factor = factor
+        self._jitter = jitter
+
+    def next(self, progressed, left):
+        # left: fraction of the objects still waited for
+        if progressed:
+            self._interval = max(self._minimum, self._interval / self._factor)
+        else:
+            self._interval = min(self._maximum, self._interval * self._factor)
+        interval = self._interval
+        if left <= 0.1:
+            interval = self._minimum
+        return interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+
+def _poll_interval(deadline, backoff, progressed, left):
+    return max(0., min(backoff.next(progressed, left), deadline.remaining()))
+
+
+def _running_patch(running):
+    return """- op: replace
+  path: /spec/running
+  value: %s""" % (
+        'true' if running else 'false'
+    )
+
+
+def _done_names(ret):
+    # with '-o name', kubectl prints 'kind.group/name' for each object
+    # it succesfully processed, and the errors on stderr
+    for line in ret.stderr.decode('utf-8').splitlines():
+        logging.warning('%s', line)
+    return set(
+        line.strip().rpartition('/')[2]
+        for line in ret.stdout.decode('utf-8').splitlines()
+        if line.strip()
+    )
+
+
+def _annotate_import(pvc_obj, endpoint, image):
+    pvc_obj.annotate({
+        "cdi.kubevirt.io/storage.import.endpoint":
+        "{endpoint}/{image}".format(endpoint=endpoint, image=image),
+        "cdi.kubevirt.io/storage.import.secretName": "",
+    })
+
+
 class Cmd:
-    def __init__(self, exe):
+    def __init__(self, exe, namespace=None):
+        # namespace: None to work in the current namespace of kubectl
         self._exe = exe
+        self._namespace = namespace
+        self._prefix = [exe]
+        if namespace is not None:
+            self._prefix += ['-n', namespace]
+
+    @property
+    def namespace(self):
+        if self._namespace is None:
+            ret = subprocess.run(
+                [self._exe, 'config', 'view', '--minify',
+                 '-o', 'jsonpath={..namespace}'],
+                stdout=subprocess.PIPE
+            )
+            self._namespace = ret.stdout.decode('utf-8').strip() or 'default'
+        return self._namespace
 
     def create(self, vm_def):
         return self._run('create', vm_def)
 
     def delete(self, vm_def):
-        return self._run('delete', vm_def)
+        # don't wait for the VM to be gone, see wait_gone
+        return self._run('delete', vm_def, '--wait=false')
 
     def start(self, vm_def):
         self._toggle(vm_def, True)
@@ -213,25 +602,64 @@ class Cmd:
     def stop(self, vm_def):
         self._toggle(vm_def, False)
 
-    def readiness_status(self, vm_defs):
+    def create_many(self, vm_defs):
+        return self._run_many('create', vm_defs)
+
+    def delete_many(self, vm_defs):
+        return self._run_many('delete', vm_defs, '--wait=false')
+
+    def delete_pvcs(self, names):
+        ret = subprocess.run(
+            self._prefix + ['delete', 'pvc'] + list(names) +
+            ['--wait=false', '-o', 'name'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        return _done_names(ret)
+
+    def start_many(self, vm_defs):
+        return self._toggle_many(vm_defs, True)
+
+    def readiness_status(self, vm_defs, pods=None):
+        if pods is None:
+            pods = self.get_pods()
+        index = index_pods(pods)
         ret = {}
-        for pod in self.get_pods():
-            for vm_def in vm_defs:
-                if pod.related_to(vm_def):
-                    ret[vm_def.name] = pod.ready
+        for vm_def in vm_defs:
+            pod = index.get(vm_def.name)
+            if pod is not None:
+                ret[vm_def.name] = pod.ready
         return ret
 
     def get_ips(self, vm_defs):
+        index = index_pods(self.get_pods())
         ret = {}
-        for pod in self.get_pods():
-            for vm_def in vm_defs:
-                if pod.related_to(vm_def):
-                    ret[vm_def.name] = pod.ip
+        for vm_def in vm_defs:
+            pod = index.get(vm_def.name)
+            if pod is not None:
+                ret[vm_def.name] = pod.ip
         return ret
 
+    def get_vms(self, selector=None):
+        selection = [] if selector is None else ['-l', selector]
+        ret = subprocess.run(
+            self._prefix + ['get', 'virtualmachines'] + selection +
+            ['-o', 'json'],
+            stdout=subprocess.PIPE
+        )
+        if ret.returncode != 0:
+            raise RuntimeError("cannot list the VMs (%s)" % selector)
+        content = json.loads(ret.stdout.decode('utf-8'))
+        return [
+            VMDef(item)
+            for item in content["items"]
+            if item["kind"] == "VirtualMachine"
+        ]
+
     def get_pods(self):
         ret = subprocess.run(
-            [self._exe, 'get', 'pods', '-o', 'json'],
+            self._prefix + ['get', 'pods', '-l', _LAUNCHER_SELECTOR,
+             '-o', 'json'],
             stdout=subprocess.PIPE
         )
         content = json.loads(ret.stdout.decode('utf-8'))
@@ -241,9 +669,27 @@ class Cmd:
             if item["kind"] == "Pod"
         )
 
+    # events: report the deletions too. Older kubectl lacks
+    # --output-watch-events: the watch exits, and the callers poll instead
+    def watch_pods(self, cond=None, events=False):
+        return self._watch(['pods', '-l', _LAUNCHER_SELECTOR], POD, cond,
+                           events)
+
+    def watch_vms(self, cond=None, events=False):
+        return self._watch(['virtualmachines'], VMDef, cond, events)
+
+    def watch_pvcs(self, cond=None, events=False):
+        return self._watch(['pvc'], PVC, cond, events)
+
+    def _watch(self, what, make_entity, cond=None, events=False):
+        flags = ['--output-watch-events'] if events else []
+        return Watcher(
+            self._prefix + ['get'] + what + ['-o', 'json', '--watch'] + flags,
+            make_entity, cond=cond)
+
     def get_pvcs(self):
         ret = subprocess.run(
-            [self._exe, 'get', 'pvc', '-o', 'json'],
+            self._prefix + ['get', 'pvc', '-o', 'json'],
             stdout=subprocess.PIPE
         )
         content = json.loads(ret.stdout.decode('utf-8'))
@@ -254,13 +700,23 @@ class Cmd:
         )
 
     def add_pvc(self, pvc_obj, endpoint, image):
-        pvc_obj.annotate({
-            "cdi.kubevirt.io/storage.import.endpoint":
-            "{endpoint}/{image}".format(endpoint=endpoint, image=image),
-            "cdi.kubevirt.io/storage.import.secretName": "",
-        })
+        _annotate_import(pvc_obj, endpoint, image)
         return self._run('apply', pvc_obj)
 
+    def add_pvcs(self, pvc_objs, endpoint, image):
+        for pvc_obj in pvc_objs:
+            _annotate_import(pvc_obj, endpoint, image)
+        return self._run_many('apply', pvc_objs)
+
+    def clone_pvc(self, pvc_obj, namespace, source):
+        pvc_obj.clone_from(namespace, source)
+        return self._run('apply', pvc_obj)
+
+    def clone_pvcs(self, pvc_objs, namespace, source):
+        for pvc_obj in pvc_objs:
+            pvc_obj.clone_from(namespace, source)
+        return self._run_many('apply', pvc_objs)
+
     def _toggle(self, vm_def, running):
         return self._runv(
             'patch',
@@ -269,15 +725,21 @@ class Cmd:
             '--type',
             'json',
             '-p',
-            """- op: replace
-  path: /spec/running
-  value: %s""" % (
-                'true' if running else 'false'
-            )
+            _running_patch(running)
         )
 
+    def _toggle_many(self, vm_defs, running):
+        ret = subprocess.run(
+            self._prefix + ['patch', 'virtualmachine'] +
+            [vm_def.name for vm_def in vm_defs] +
+            ['--type', 'json', '-p', _running_patch(running), '-o', 'name'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        return _done_names(ret)
+
     def _runv(self, *args):
-        cmd = [self._exe] + list(args)
+        cmd = self._prefix + list(args)
         ret = subprocess.run(
             cmd,
             stdout=subprocess.PIPE
@@ -286,9 +748,19 @@ class Cmd:
             raise RuntimeError("command failed: [%s] " % (' '.join(cmd)))
         return ret
 
-    def _run(self, action, spec):
+    def _run_many(self, action, specs, *args):
+        # kubectl keeps going on errors, so we check object by object
+        ret = subprocess.run(
+            self._prefix + [action, '-o', 'name', '-f', '-'] + list(args),
+            input='---\n'.join(spec.to_yaml() for spec in specs).encode('utf-8'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        return _done_names(ret)
+
+    def _run(self, action, spec, *args):
         ret = subprocess.run(
-            [self._exe, action, '-f', '-'],
+            self._prefix + [action, '-f', '-'] + list(args),
             input=spec.to_bytes(),
             stdout=subprocess.PIPE
         )
@@ -297,56 +769,346 @@ class Cmd:
         return ret
 
 
-def wait_ready_vm(cmd, vm_defs, timeout):
-    elapsed = 0  # seconds
-    step = 1.0  # seconds
-    while True:
-        if elapsed >= timeout:
-            raise TimeoutError("waited %s seconds" % timeout)
+class ApiError(RuntimeError):
+    pass
 
-        ready, waiting = set(), set()
-        for vm_name, all_ready in cmd.readiness_status(vm_defs).items():
-            if all_ready:
-                ready.add(vm_name)
+
+class _HTTPStream:
+    # a watch response, quacking like the Popen the Watcher reads from
+    def __init__(self, conn, resp):
+        self._conn = conn
+        self._resp = resp
+        self._closed = False
+        self.stdout = self
+
+    def read1(self, size):
+        try:
+            return self._resp.read1(size)
+        except (http.client.HTTPException, OSError, ValueError):
+            return b''
+
+    def poll(self):
+        return 0 if self._closed else None
+
+    def terminate(self):
+        if self._conn.sock is not None:
+            try:
+                self._conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait(self):
+        self._closed = True
+        self._conn.close()
+
+
+class ApiCmd(Cmd):
+    # talks to the API server over a single keep-alive connection
+    def __init__(self, url, namespace=None, token=None,
+                 timeout=_API_TIMEOUT, vm_api=_KUBEVIRT_API):
+        # vm_api: group/version of the VMs, as in their definition
+        parts = urllib.parse.urlsplit(url)
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._base = parts.path.rstrip('/')
+        # there is no current namespace without kubectl
+        self._namespace = namespace or "default"
+        self._token = token
+        self._timeout = timeout
+        self._vm_api = vm_api
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def get_vms(self, selector=None):
+        path = self._path(self._vm_api, "VirtualMachine")
+        return [VMDef(item) for item in self._list(path, selector)]
+
+    def get_pods(self):
+        return set(
+            POD(item)
+            for item in self._list(self._path("v1", "Pod"),
+                                   _LAUNCHER_SELECTOR)
+        )
+
+    def get_pvcs(self):
+        return set(
+            PVC(item)
+            for item in self._list(self._path("v1", "PersistentVolumeClaim"))
+        )
+
+    # the API server always reports the deletions
+    def watch_vms(self, cond=None, events=False):
+        return self._watch(self._path(self._vm_api, "VirtualMachine"),
+                           VMDef, cond=cond)
+
+    def watch_pods(self, cond=None, events=False):
+        return self._watch(self._path("v1", "Pod"), POD, cond,
+                           _LAUNCHER_SELECTOR)
+
+    def watch_pvcs(self, cond=None, events=False):
+        return self._watch(self._path("v1", "PersistentVolumeClaim"), PVC,
+                           cond)
+
+    def delete_pvcs(self, names):
+        path = self._path("v1", "PersistentVolumeClaim")
+        done = set()
+        for name in names:
+            try:
+                self._delete('%s/%s' % (path, name))
+            except (ApiError, OSError, http.client.HTTPException) as exc:
+                logging.warning('%s', exc)
+            else:
+                done.add(name)
+        return done
+
+    def _toggle(self, vm_def, running):
+        status, content = self._request(
+            'PATCH',
+            '%s/%s' % (self._path(self._vm_api, "VirtualMachine"),
+                       vm_def.name),
+            yaml.safe_load(_running_patch(running)),
+            'application/json-patch+json')
+        _check_status(status, content, 'patch on %s' % vm_def.name)
+
+    def _toggle_many(self, vm_defs, running):
+        return self._each(
+            lambda vm_def: self._toggle(vm_def, running), vm_defs)
+
+    def _run_many(self, action, specs, *args):
+        return self._each(lambda spec: self._run(action, spec), specs)
+
+    def _run(self, action, spec, *args):
+        # kubectl arguments are meaningless here: deletion never waits
+        obj = spec.to_dict()
+        path = self._path(obj["apiVersion"], obj["kind"])
+        what = '%s on %s' % (action, spec.name)
+        if action == 'delete':
+            self._delete('%s/%s' % (path, spec.name))
+            return
+        status, content = self._request('POST', path, obj)
+        if status == http.client.CONFLICT and action == 'apply':
+            status, content = self._request(
+                'PATCH', '%s/%s' % (path, spec.name), obj,
+                'application/merge-patch+json')
+        _check_status(status, content, what)
+
+    def _each(self, func, specs):
+        done = set()
+        for spec in specs:
+            try:
+                func(spec)
+            except (ApiError, OSError, http.client.HTTPException) as exc:
+                logging.warning('%s', exc)
             else:
-                waiting.add(vm_name)
+                done.add(spec.name)
+        return done
+
+    def _delete(self, path):
+        status, content = self._request(
+            'DELETE', path, {"propagationPolicy": "Background"})
+        _check_status(status, content, 'delete on %s' % path)
+
+    def _path(self, api_version, kind):
+        group = 'api' if '/' not in api_version else 'apis'
+        return '/%s/%s/namespaces/%s/%ss' % (
+            group, api_version, self._namespace, kind.lower())
+
+    def _list(self, path, selector=None):
+        query = {} if selector is None else {"labelSelector": selector}
+        status, content = self._request('GET', path, query=query)
+        _check_status(status, content, 'list on %s' % path)
+        # unlike kubectl, the API server omits the type of the items
+        kind = content.get("kind", "")
+        for item in content["items"]:
+            item.setdefault("apiVersion", content.get("apiVersion"))
+            if kind.endswith("List"):
+                item.setdefault("kind", kind[:-len("List")])
+        return content["items"]
+
+    def _watch(self, path, make_entity, cond=None, selector=None):
+        query = {"watch": "true"}
+        if selector is not None:
+            query["labelSelector"] = selector
+        conn = self._connect(timeout=None)
+        conn.request('GET', self._url(path, query), headers=self._headers())
+        resp = conn.getresponse()
+        if resp.status != http.client.OK:
+            conn.close()
+            raise ApiError('watch on %s failed: %s' % (path, resp.status))
+        return Watcher(None, make_entity, proc=_HTTPStream(conn, resp),
+                       cond=cond)
+
+    def _connect(self, timeout=_API_TIMEOUT):
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(
+                self._netloc, timeout=timeout,
+                context=ssl.create_default_context())
+        return http.client.HTTPConnection(self._netloc, timeout=timeout)
+
+    def _url(self, path, query=None):
+        url = self._base + path
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        return url
+
+    def _headers(self, content_type=None):
+        headers = {"Accept": "application/json"}
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        if self._token:
+            headers["Authorization"] = "Bearer %s" % self._token
+        return headers
+
+    def _request(self, method, path, body=None,
+                 content_type='application/json', query=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        headers = self._headers(None if body is None else content_type)
+        with self._lock:
+            # the server may have closed the idle connection: retry once
+            for attempt in range(2):
+                if self._conn is None:
+                    self._conn = self._connect(self._timeout)
+                try:
+                    self._conn.request(method, self._url(path, query),
+                                       body=data, headers=headers)
+                    resp = self._conn.getresponse()
+                    payload = resp.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    self._conn.close()
+                    self._conn = None
+                    if attempt > 0:
+                        raise
+        try:
+            content = json.loads(payload.decode('utf-8')) if payload else None
+        except ValueError:
+            content = None
+        if method == 'POST' and attempt > 0 and \
+                resp.status == http.client.CONFLICT:
+            # the first attempt created the object, but its response
+            # was lost
+            logging.info('%s: created by the first attempt', path)
+            return http.client.CREATED, content
+        return resp.status, content
+
+
+def _check_status(status, content, what):
+    if status >= 300:
+        message = content.get("message") if isinstance(content, dict) else ''
+        raise ApiError("%s failed: %s %s" % (what, status, message))
+
+
+def make_cmd(command, namespace=None, vm_api=_KUBEVIRT_API):
+    if command.startswith(_API_PREFIXES):
+        return ApiCmd(command, namespace,
+                      os.environ.get("BENCHKIT_API_TOKEN"), vm_api=vm_api)
+    return Cmd(command, namespace)
+
+
+def wait_ready_vm(cmd, vm_defs, timeout, watch=False):
+    watcher = _start_watch(cmd.watch_pods) if watch else None
+    try:
+        return _wait_ready_vm(cmd, vm_defs, timeout, watcher)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def _wait_ready_vm(cmd, vm_defs, timeout, watcher):
+    # returns the seconds each VM took to become ready
+    deadline = Deadline(timeout)
+    backoff = Backoff(1.0, 0.5, 10.0)
+    vm_names = set(vm_def.name for vm_def in vm_defs)
+    ready_at = {}
+    ready = set()
+    while True:
+        pods = watcher.snapshot() if _watching(watcher) else None
+        prev_ready, ready = ready, set(
+            vm_name
+            for vm_name, all_ready in cmd.readiness_status(vm_defs, pods).items()
+            if all_ready
+        )
+        _record_ready(ready, ready_at, deadline.elapsed())
+        # VMs without pods yet are waiting as well
+        waiting = vm_names - ready
         if not waiting:
             break
+        if deadline.expired():
+            raise TimeoutError("waited %s seconds" % timeout)
 
         logging.info(
             "%i/%i VM ready, waiting...", len(ready), len(vm_defs))
-        time.sleep(step)
-        elapsed += step
+        _pause(watcher, _poll_interval(
+            deadline, backoff, len(ready) > len(prev_ready),
+            len(waiting) / len(vm_names)))
+
+    log_durations('time to ready (vm)', ready_at)
+    return ready_at
 
 
-def wait_ready_pvc(cmd, pvc_defs, timeout):
-    elapsed = 0  # seconds
-    step = 5.0  # seconds
+def _record_ready(ready, ready_at, elapsed):
+    for name in sorted(ready):
+        if name not in ready_at:
+            logging.info("ready: %s (%.1fs)", name, elapsed)
+            ready_at[name] = elapsed
+
+
+def wait_ready_pvc(cmd, pvc_defs, timeout, watch=False):
+    watcher = _start_watch(cmd.watch_pvcs) if watch else None
+    try:
+        return _wait_ready_pvc(cmd, pvc_defs, timeout, watcher)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def _wait_ready_pvc(cmd, pvc_defs, timeout, watcher):
+    # returns the seconds each PVC took to become ready
+    deadline = Deadline(timeout)
+    backoff = Backoff(5.0, 1.0, 30.0)
     pvc_names = set(pvc.name for pvc in pvc_defs)
+    ready_at = {}
+    ready = set()
     while True:
-        if elapsed >= timeout:
-            raise TimeoutError("waited %s seconds" % timeout)
-
-        ready, waiting = set(), set()
-        for pvc in cmd.get_pvcs():
-            if pvc.name not in pvc_names:
-                # ignore if not provisioned this time
-                continue
-            if pvc.import_phase == "Succeeded":
-                logging.info("ready: %s" % (pvc.name))
-                ready.add(pvc.name)
-            else:
-                waiting.add(pvc.name)
+        pvcs = watcher.snapshot() if _watching(watcher) else cmd.get_pvcs()
+        prev_ready, ready = ready, set(
+            # ignore if not provisioned this time
+            pvc.name for pvc in pvcs if pvc.name in pvc_names and pvc.ready
+        )
+        _record_ready(ready, ready_at, deadline.elapsed())
+        # PVCs not listed yet are waiting as well
+        waiting = pvc_names - ready
         if not waiting:
             break
+        if deadline.expired():
+            raise TimeoutError("waited %s seconds" % timeout)
 
         logging.info(
             "%i/%i PVC ready, waiting...", len(ready), len(pvc_defs))
-        time.sleep(step)
-        elapsed += step
+        _pause(watcher, _poll_interval(
+            deadline, backoff, len(ready) > len(prev_ready),
+            len(waiting) / len(pvc_names)))
+
+    log_durations('time to ready (pvc)', ready_at)
+    return ready_at
+
+
+def _check_many(vm_defs, done, action, fail_action):
+    ret = []
+    for vm_def in vm_defs:
+        if vm_def.name in done:
+            ret.append(vm_def)
+            logging.info('%s: %s', action, vm_def.name)
+        else:
+            logging.warning('failed to %s: %s', fail_action, vm_def.name)
+    return ret
 
 
-def setup(cmd, vm_defs):
+def setup(cmd, vm_defs, bulk=False):
+    if bulk:
+        return _check_many(
+            vm_defs, cmd.create_many(vm_defs), 'created', 'create')
+
     created = []
     for vm_def in vm_defs:
         try:
@@ -359,14 +1121,21 @@ def setup(cmd, vm_defs):
     return created
 
 
-def start(cmd, vm_defs):
+def start(cmd, vm_defs, bulk=False):
+    if bulk:
+        return _check_many(
+            vm_defs, cmd.start_many(vm_defs), 'started', 'start')
+
+    started = []
     for vm_def in vm_defs:
         try:
             cmd.start(vm_def)
         except Exception as exc:
-            logging.warning('failed to create: %s (%s)', vm_def.name, exc)
+            logging.warning('failed to start: %s (%s)', vm_def.name, exc)
         else:
+            started.append(vm_def)
             logging.info('started: %s', vm_def.name)
+    return started
 
 
 def _skip_volume(vol, pvc_names):
@@ -397,6 +1166,8 @@ def _skip_volume(vol, pvc_names):
     return False
 
 
+# the same image is looked up for all the volumes
+@functools.lru_cache(maxsize=None)
 def find_image_size(endpoint, image, timeout=1):
     url = '%s/info/%s' % (endpoint, image)
     try:
@@ -405,15 +1176,38 @@ def find_image_size(endpoint, image, timeout=1):
         # Out of date image server. Return old value for backward
         # compatibility.
         # However, the correct thing to do would be raise a exception.
+        return _DEFAULT_IMAGE_SIZE
     else:
         return max(1, result.get("virtual-size", 0) / 1024. / 1024. / 1024.)
 
 
-def provision(cmd, vm_defs, endpoint, image):
+def provision_golden(cmd, name, endpoint, image):
+    for pvc in cmd.get_pvcs():
+        if pvc.name == name:
+            logging.info("provision: golden image %s already present" % name)
+            return pvc
+
+    size = find_image_size(endpoint, image)
+    logging.info("provision: import %s on golden %s (%d Gi)" % (
+        image, name, size))
+    pvc = PVC.from_yaml(_PVC_TMPL.format(name=name, size=size))
+    cmd.add_pvc(pvc, endpoint, image)
+    return pvc
+
+
+def provision(cmd, vm_defs, endpoint, image, bulk=False, golden=None):
+    # golden: (namespace, name) of the PVC to clone, instead of importing
     pvc_names = set(pvc.name for pvc in cmd.get_pvcs())
     logging.info("provision: start (%d pvcs already found)" % (len(pvc_names)))
 
-    provisioned = set()
+    if golden is None:
+        source = dict(endpoint=endpoint, image=image)
+        add_pvc, add_pvcs = cmd.add_pvc, cmd.add_pvcs
+    else:
+        source = dict(namespace=golden[0], source=golden[1])
+        add_pvc, add_pvcs = cmd.clone_pvc, cmd.clone_pvcs
+
+    pvcs = []
     for vm_def in vm_defs:
         for vol in vm_def.volumes:
             if _skip_volume(vol, pvc_names):
@@ -423,15 +1217,31 @@ def provision(cmd, vm_defs, endpoint, image):
 
             logging.info("provision: add volume %s.%s on %s (%d Gi)" % (
                 vm_def.name, vol.name, vol.claim_name, size))
-            pvc = PVC.from_yaml(_PVC_TMPL.format(name=vol.claim_name, size=size))
-            cmd.add_pvc(pvc, endpoint, image)
+            pvcs.append(PVC.from_yaml(
+                _PVC_TMPL.format(name=vol.claim_name, size=size)))
+
+    if bulk and pvcs:
+        done = add_pvcs(pvcs, **source)
+        provisioned = set(pvc for pvc in pvcs if pvc.name in done)
+        for pvc in pvcs:
+            if pvc not in provisioned:
+                logging.warning('failed to provision: %s', pvc.name)
+    else:
+        provisioned = set()
+        for pvc in pvcs:
+            add_pvc(pvc, **source)
             provisioned.add(pvc)
 
     logging.info("provision: done")
     return provisioned
 
 
-def teardown(cmd, vm_defs):
+def teardown(cmd, vm_defs, bulk=False):
+    if bulk:
+        return _check_many(
+            vm_defs, cmd.delete_many(vm_defs), 'deleted', 'delete')
+
+    deleted = []
     for vm_def in vm_defs:
         # clean as much as we can:
         try:
@@ -441,6 +1251,170 @@ def teardown(cmd, vm_defs):
             logging.warning('cannot delete %s: %s', vm_def.name, exc)
         else:
             logging.info('deleted: %s', vm_def.name)
+            deleted.append(vm_def)
+    return deleted
+
+
+def delete_claims(cmd, vm_defs, bulk=False):
+    claims = claim_names(vm_defs)
+    if bulk:
+        done = cmd.delete_pvcs(claims) if claims else set()
+    else:
+        done = set()
+        for claim in claims:
+            done |= cmd.delete_pvcs([claim])
+    deleted = []
+    for claim in claims:
+        if claim in done:
+            logging.info('deleted: pvc %s', claim)
+            deleted.append(claim)
+        else:
+            logging.warning('failed to delete: pvc %s', claim)
+    return deleted
+
+
+def claim_names(vm_defs):
+    ret = []
+    for vm_def in vm_defs:
+        vol = vm_def.rootvolume()
+        if vol is not None and vol.has_claim:
+            ret.append(vol.claim_name)
+    return ret
+
+
+def percentile(values, pct):
+    # nearest rank, same as runbench.percentile: the scripts are standalone
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100. * len(ordered))))
+    return ordered[rank - 1]
+
+
+def log_durations(what, durations):
+    if not durations:
+        return
+    values = list(durations.values())
+    logging.info("%s: p50 %.1fs, p95 %.1fs, max %.1fs (%d objects)",
+                 what, percentile(values, 50), percentile(values, 95),
+                 max(values), len(values))
+
+
+def _present(cmd, kind):
+    if kind == 'vm':
+        return set(vm.name for vm in cmd.get_vms())
+    if kind == 'pod':
+        return set(index_pods(cmd.get_pods()))
+    return set(pvc.name for pvc in cmd.get_pvcs())
+
+
+def _deleted(kind, watcher):
+    if kind == 'pod':
+        return set(pod.domain for pod in watcher.deleted())
+    return set(obj.name for obj in watcher.deleted())
+
+
+def wait_gone(cmd, vm_defs, pvc_names, timeout, watch=False):
+    # returns the seconds each (kind, name) took to disappear
+    watchers = {}
+    if watch:
+        cond = threading.Condition()
+        kinds = []
+        if vm_defs:
+            kinds += [('vm', cmd.watch_vms), ('pod', cmd.watch_pods)]
+        if pvc_names:
+            kinds.append(('pvc', cmd.watch_pvcs))
+        for kind, watch_kind in kinds:
+            watcher = _start_watch(
+                functools.partial(watch_kind, cond, events=True))
+            if watcher is not None:
+                watchers[kind] = watcher
+    try:
+        return _wait_gone(cmd, vm_defs, pvc_names, timeout, watchers)
+    finally:
+        for watcher in watchers.values():
+            watcher.close()
+
+
+def _wait_gone(cmd, vm_defs, pvc_names, timeout, watchers):
+    # watchers: kind -> Watcher. A kind is listed until its watch started,
+    # then its deletion events tell what is gone.
+    deadline = Deadline(timeout)
+    backoff = Backoff(2.0, 0.5, 10.0)
+    pending = set()
+    for vm_def in vm_defs:
+        # the VM is gone once its launcher pod is
+        pending.add(('vm', vm_def.name))
+        pending.add(('pod', vm_def.name))
+    pending.update(('pvc', name) for name in pvc_names)
+    total = len(pending)
+    tracked = set()  # kinds listed once their watch started
+    gone = {}
+    while pending:
+        vanished = set()
+        for kind in sorted(set(kind for kind, _ in pending)):
+            names = set(name for obj_kind, name in pending if obj_kind == kind)
+            watcher = watchers.get(kind)
+            if kind in tracked and not _watching(watcher):
+                logging.warning("watch of %s stopped, polling", kind)
+                tracked.discard(kind)
+                watcher = None
+            if kind in tracked:
+                names &= _deleted(kind, watcher)
+            else:
+                if _watching(watcher) and watcher.started:
+                    tracked.add(kind)
+                names -= _present(cmd, kind)
+            vanished.update((kind, name) for name in names)
+        elapsed = deadline.elapsed()
+        for kind, name in sorted(vanished):
+            logging.info("gone: %s %s (%.1fs)", kind, name, elapsed)
+            gone[(kind, name)] = elapsed
+        pending -= vanished
+        if not pending:
+            break
+        if deadline.expired():
+            raise TimeoutError("waited %s seconds" % timeout)
+
+        logging.info("%i/%i objects gone, waiting...", len(gone), total)
+        _pause_any(list(watchers.values()), _poll_interval(
+            deadline, backoff, bool(vanished), len(pending) / total))
+
+    for kind in ('vm', 'pod', 'pvc'):
+        log_durations('time to gone (%s)' % kind, {
+            name: elapsed for (obj_kind, name), elapsed in gone.items()
+            if obj_kind == kind
+        })
+    return gone
+
+
+def _teardown(cmd, args, vm_defs):
+    deleted = teardown(cmd, vm_defs, args.bulk)
+    pvcs = []
+    if args.delete_pvcs:
+        pvcs = delete_claims(cmd, deleted, args.bulk)
+    if args.timeout > 0:
+        try:
+            wait_gone(cmd, deleted, pvcs, args.timeout, args.watch)
+        except TimeoutError:
+            return False
+    return True
+
+
+def pool_selector(pool):
+    return "%s=%s" % (_POOL_LABEL, pool)
+
+
+def reconcile_pool(cmd, vm_defs, pool):
+    # returns the VMs to add, to keep and to remove to match vm_defs
+    existing = {vm.name: vm for vm in cmd.get_vms(pool_selector(pool))}
+    wanted = set(vm_def.name for vm_def in vm_defs)
+    to_add = [vm_def for vm_def in vm_defs if vm_def.name not in existing]
+    warm = [vm_def for vm_def in vm_defs if vm_def.name in existing]
+    to_remove = [
+        vm for name, vm in sorted(existing.items()) if name not in wanted
+    ]
+    logging.info("pool %s: %d warm, %d to add, %d to remove" % (
+        pool, len(warm), len(to_add), len(to_remove)))
+    return to_add, warm, to_remove
 
 
 def dump_hosts(vms, out):
@@ -462,6 +1436,73 @@ def _wait_user():
 
 
 
+def _provision(cmd, args, vm_defs):
+    golden = None
+    if args.golden_pvc is not None:
+        golden_cmd = cmd
+        if args.golden_namespace is not None:
+            golden_cmd = make_cmd(args.command, args.golden_namespace)
+        golden_pvc = provision_golden(
+            golden_cmd, args.golden_pvc, args.endpoint, args.image)
+        if args.timeout > 0:
+            try:
+                wait_ready_pvc(golden_cmd, [golden_pvc], args.timeout,
+                               args.watch)
+            except TimeoutError:
+                return False
+        golden = (golden_cmd.namespace, args.golden_pvc)
+    provisioned = provision(cmd, vm_defs, args.endpoint, args.image,
+                            args.bulk, golden)
+    if args.timeout > 0:
+        try:
+            wait_ready_pvc(cmd, provisioned, args.timeout, args.watch)
+        except TimeoutError:
+            return False
+    return True
+
+
+def _write_hosts(cmd, vm_defs, hosts_file):
+    if hosts_file == '-':
+        dump_hosts(cmd.get_ips(vm_defs), sys.stdout)
+    else:
+        with open(hosts_file, 'wt') as hf:
+            dump_hosts(cmd.get_ips(vm_defs), hf)
+
+
+def _run_pool(cmd, args, vm_defs):
+    # the pool is left running: teardown only removes the VMs in excess
+    if args.teardown_only:
+        vm_defs = []
+    to_add, warm, to_remove = reconcile_pool(cmd, vm_defs, args.pool)
+    if to_remove and not _teardown(cmd, args, to_remove):
+        return 1
+    if not vm_defs:
+        return 0
+
+    if to_add:
+        if not _provision(cmd, args, to_add):
+            return 1
+        if args.provision_only:
+            return 0
+        to_add = setup(cmd, to_add, args.bulk)
+
+    # warm VMs may have been stopped meanwhile
+    status = cmd.readiness_status(warm)
+    idle = [vm_def for vm_def in warm if not status.get(vm_def.name)]
+    running = [vm_def for vm_def in warm if status.get(vm_def.name)]
+    if to_add or idle:
+        running += start(cmd, to_add + idle, args.bulk)
+
+    if args.timeout > 0:
+        try:
+            wait_ready_vm(cmd, running, args.timeout, args.watch)
+        except TimeoutError:
+            return 1
+    if not args.setup_only:
+        _write_hosts(cmd, running, args.hosts_file)
+    return 0
+
+
 def _main():
     logging.basicConfig(
         format='%(asctime)s %(message)s',
@@ -471,52 +1512,49 @@ def _main():
 
     args = _configure()
 
-    cmd = Cmd(args.command)
-
     with open(args.spec) as src:
-        vm_master_def = yaml.load(src)
+        vm_master_def = yaml.load(src, Loader=_YAML_LOADER)
 
-    vm_defs = [
-        VMDef(vm_master_def, ident) for ident in range(args.instances)
-    ]
+    cmd = make_cmd(args.command, args.namespace,
+                   vm_master_def.get("apiVersion", _KUBEVIRT_API))
+
+    if args.pool is not None:
+        labels = vm_master_def["metadata"].setdefault("labels", {})
+        labels[_POOL_LABEL] = args.pool
+    vm_defs = make_vm_defs(vm_master_def, args.instances)
     logging.info('%d VM definitions', len(vm_defs))
 
+    if args.pool is not None:
+        return _run_pool(cmd, args, vm_defs)
+
     if not args.teardown_only:
-        provisioned = provision(cmd, vm_defs, args.endpoint, args.image)
-        if args.timeout > 0:
-            try:
-                wait_ready_pvc(cmd, provisioned, args.timeout)
-            except TimeoutError:
-                return 1
+        if not _provision(cmd, args, vm_defs):
+            return 1
         if args.provision_only:
             return 0
 
     need_wait_user = False
     if not args.teardown_only:
-        created = setup(cmd, vm_defs)
+        created = setup(cmd, vm_defs, args.bulk)
 
-        start(cmd, created)
+        # the VMs which failed to start are torn down, not waited for
+        running = start(cmd, created, args.bulk)
 
         if args.timeout > 0:
             try:
-                wait_ready_vm(cmd, created, args.timeout)
+                wait_ready_vm(cmd, running, args.timeout, args.watch)
             except TimeoutError:
                 return 1
         need_wait_user = True
 
     if need_wait_user and not args.setup_only and not args.teardown_only:
-        if args.hosts_file == '-':
-            dump_hosts(cmd.get_ips(created), sys.stdout)
-        else:
-            with open(args.hosts_file, 'wt') as hf:
-                dump_hosts(cmd.get_ips(created), hf)
-
+        _write_hosts(cmd, running, args.hosts_file)
         _wait_user()
 
     if not args.setup_only:
         target = created if not args.teardown_only else vm_defs
-        teardown(cmd, target)
-        # TODO: add wait_gone here
+        if not _teardown(cmd, args, target):
+            return 1
 
 
 if __name__ == "__main__":
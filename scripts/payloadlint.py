@@ -3,32 +3,209 @@
 # License: Apache v2
 
 import argparse
+import hashlib
+import heapq
+import json
 import logging
 import os.path
 import stat
+import subprocess
 import sys
 import tarfile
 
 
 _ENTRYPOINT = 'payload.sh'
+_ZSTD_SUFFIXES = ('.tar.zst', '.tzst')
+# top-level directories a payload should never write into
+_SYSTEM_DIRS = (
+    'bin', 'boot', 'dev', 'etc', 'lib', 'lib64', 'proc', 'root', 'run',
+    'sbin', 'sys', 'usr', 'var',
+)
+_MEMBER_TYPES = (
+    ('file', tarfile.TarInfo.isfile),
+    ('dir', tarfile.TarInfo.isdir),
+    ('symlink', tarfile.TarInfo.issym),
+    ('hardlink', tarfile.TarInfo.islnk),
+)
+
+
+class ZstdReader:
+    # decompresses with the zstd tool, like the VMs do
+    def __init__(self, payload):
+        self._proc = subprocess.Popen(['zstd', '-dc', payload],
+                                      stdout=subprocess.PIPE)
+        self.stream = self._proc.stdout
+
+    def close(self):
+        # returns False if the zstd tool failed
+        self.stream.close()
+        if self._proc.poll() is None:
+            # we stopped reading early
+            self._proc.terminate()
+        # killed by a signal (SIGPIPE or ours) only if we stopped early
+        return self._proc.wait() <= 0
+
+
+def open_zstd(payload):
+    src = ZstdReader(payload)
+    try:
+        return tarfile.open(fileobj=src.stream, mode='r|'), src
+    except Exception:
+        src.close()
+        raise
+
+
+def open_payload(payload):
+    # streaming mode: members are read once, in order, and never indexed.
+    # Returns the tar, its format and the decompressor to close, if any.
+    if payload.endswith(_ZSTD_SUFFIXES):
+        tar, src = open_zstd(payload)
+        return tar, 'zstd-compressed tar', src
+    return tarfile.open(payload, mode='r|gz'), 'gzip-compressed tar', None
+
+
+def is_entrypoint(info):
+    return os.path.normpath(info.name) == _ENTRYPOINT
 
 
 def find_entrypoint(tar):
-    for info in tar.getmembers():
-        if os.path.normpath(info.name) == _ENTRYPOINT:
+    # stops reading the payload as soon as the entrypoint is found
+    for info in tar:
+        if is_entrypoint(info):
             return info
     return None
 
 
-def lint(payload):
+def _escapes(path):
+    return path == '..' or path.startswith('../')
+
+
+def path_issues(info):
+    issues = []
+    path = os.path.normpath(info.name)
+    if os.path.isabs(path):
+        issues.append('absolute path')
+        if path.lstrip('/').split('/')[0] in _SYSTEM_DIRS:
+            issues.append('overwrites system path')
+    elif _escapes(path):
+        issues.append('outside the root')
+    if info.issym():
+        target = os.path.normpath(
+            os.path.join(os.path.dirname(path), info.linkname))
+        if os.path.isabs(info.linkname) or _escapes(target):
+            issues.append('symlink outside the root')
+    elif info.islnk():
+        target = os.path.normpath(info.linkname)
+        if os.path.isabs(target) or _escapes(target):
+            issues.append('hardlink outside the root')
+    if info.isdev():
+        issues.append('device file')
+    return issues
+
+
+def file_digest(src, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: src.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_entry(info, src=None):
+    entry = {
+        'name': os.path.normpath(info.name),
+        'type': 'other',
+        'size': info.size,
+        'mode': '%04o' % info.mode,
+    }
+    for name, check in _MEMBER_TYPES:
+        if check(info):
+            entry['type'] = name
+            break
+    if src is not None:
+        entry['sha256'] = file_digest(src)
+    if info.issym() or info.islnk():
+        entry['linkname'] = info.linkname
+    return entry
+
+
+class Scan:
+    def __init__(self, top=5, deep=False):
+        self.members = 0
+        self.size = 0
+        self.largest = []  # (size, name), min-heap of the top largest files
+        self.entrypoint = None
+        self.files = []  # manifest entries, deep mode only
+        self.issues = []  # (name, issue), deep mode only
+        self._top = top
+        self._deep = deep
+
+    def add(self, info, src=None):
+        self.members += 1
+        if self._deep:
+            self.files.append(manifest_entry(info, src))
+            self.issues.extend(
+                (info.name, issue) for issue in path_issues(info))
+        if info.isfile():
+            self.size += info.size
+            item = (info.size, info.name)
+            if len(self.largest) < self._top:
+                heapq.heappush(self.largest, item)
+            elif item > self.largest[0]:
+                heapq.heapreplace(self.largest, item)
+        if self.entrypoint is None and is_entrypoint(info):
+            self.entrypoint = info
+
+    def report(self):
+        logging.info('scan: %d members, %d bytes uncompressed' % (
+            self.members, self.size))
+        for size, name in sorted(self.largest, reverse=True):
+            logging.info('scan: %12d %s' % (size, name))
+
+
+def scan_payload(tar, top=5, deep=False):
+    scan = Scan(top, deep)
+    for info in tar:
+        # in streaming mode, the content is readable only until the next member
+        src = tar.extractfile(info) if deep and info.isfile() else None
+        scan.add(info, src)
+    return scan
+
+
+def write_manifest(path, payload, scan):
+    manifest = {
+        'payload': os.path.basename(payload),
+        'members': scan.members,
+        'size': scan.size,
+        'files': scan.files,
+    }
+    with open(path, 'wt') as dst:
+        json.dump(manifest, dst, indent=1, sort_keys=True)
+
+
+def lint(payload, full_scan=False, top=5, deep=False, manifest=None):
     try:
-        tar = tarfile.open(payload, mode='r:gz')
+        tar, fmt, src = open_payload(payload)
     except (OSError, tarfile.TarError):
         logging.error('format: unsupported %s' % payload)
         return -1
-    logging.debug('format: gzip-compressed tar')
+    logging.debug('format: %s' % fmt)
 
-    entrypoint = find_entrypoint(tar)
+    try:
+        if full_scan or deep:
+            scan = scan_payload(tar, top, deep)
+            scan.report()
+            entrypoint = scan.entrypoint
+        else:
+            entrypoint = find_entrypoint(tar)
+    except (OSError, EOFError, tarfile.TarError) as exc:
+        logging.error('format: corrupted %s: %s' % (payload, exc))
+        return -1
+    finally:
+        tar.close()
+        decompressed = src is None or src.close()
+    if not decompressed:
+        logging.error('format: corrupted %s: zstd failed' % payload)
+        return -1
     if entrypoint is None:
         logging.error('entrypoint: missing payload.sh')
         return -1
@@ -37,10 +214,23 @@ def lint(payload):
     if not entrypoint.isfile():
         logging.error('entrypoint: not regular file')
         return -1
-    if not (entrypoint.mode & (stat.S_IRUSR|stat.S_IXUSR)):
+    needed = stat.S_IRUSR | stat.S_IXUSR
+    if entrypoint.mode & needed != needed:
         logging.error('entrypoint: not executable')
+        return -1
     logging.debug('entrypoint: regular and executable')
 
+    if deep:
+        for name, issue in scan.issues:
+            logging.error('path: %s: %s' % (name, issue))
+        if scan.issues:
+            return -1
+        logging.debug('path: all members inside the root')
+        if manifest is not None:
+            write_manifest(manifest, payload, scan)
+            logging.info('manifest: %d members -> %s' % (
+                len(scan.files), manifest))
+
     logging.info('payload: OK')
     return 0
     
@@ -60,13 +250,27 @@ def _main():
         description="A payload file linter tool")
     parser.add_argument("-v", "--verbose", action="count",
                         help="increase the verbosiness level")
+    parser.add_argument("-f", "--full-scan", action="store_true",
+                        help="read the whole payload, and report its"
+                        " uncompressed size, member count and largest files")
+    parser.add_argument("--top", type=int, default=5,
+                        help="number of largest files to report in"
+                        " full scan mode")
+    parser.add_argument("-D", "--deep", action="store_true",
+                        help="read the whole payload, and check that all"
+                        " the members stay inside the payload root")
+    parser.add_argument("-M", "--manifest", type=str, default=None,
+                        help="in deep mode, write the manifest of the payload"
+                        " (digest, size and mode of each member) as JSON"
+                        " in this file - implies --deep")
     parser.add_argument("payload")
 
     args = parser.parse_args(sys.argv[1:])
 
     logging.basicConfig(format='%(levelname)s - %(message)s',
                         level=level_from_verbose(args.verbose))
-    return lint(args.payload)
+    return lint(args.payload, args.full_scan, args.top,
+                args.deep or args.manifest is not None, args.manifest)
 
 
 if __name__ == "__main__":
@@ -4,20 +4,67 @@
 
 import yaml
 from pssh.clients import ParallelSSHClient
+from pssh.exceptions import Timeout
 import gevent
+import gevent.event
+import gevent.pool
 
 import argparse
+import collections
+import contextlib
 import copy
+import hashlib
+import itertools
 import json
 import logging
+import math
 import os.path
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import uuid
 
 
-_AUTH_METHODS = ("password",)
+_AUTH_METHODS = ("password", "key", "agent")
+_STREAM_MODES = ("none", "host", "tagged")
+# per host files kept open at once in the 'host' streaming mode
+_MAX_STREAM_FILES = 128
+_DISTRIBUTE_MODES = ("copy", "tree")
+_WIRE_COMPRESSIONS = ("gzip", "zstd")
+_ZSTD_SUFFIXES = (".tar.zst", ".tzst")
+_GZIP_SUFFIXES = (".tar.gz", ".tgz")
+# holds the digest of the payload currently unpacked in the root
+_PAYLOAD_STAMP = '.benchkit-payload'
+# holds the time the payload actually started at, remote clock
+_STARTED_STAMP = '.benchkit-started'
+# holds the process group of the running payload, to stop all its processes
+_PGID_STAMP = '.benchkit-pgid'
+_CLOCK_CMD = '/usr/bin/date +%s.%N'
+_STOP_TIMEOUT = 10  # seconds
+_PROBE_CMD = '/usr/bin/true'
+# holds the chunks of the payload being uploaded, one subdirectory per digest
+_CHUNKS_DIR = '.benchkit-chunks'
+# holds the checksums of the payload files, to verify the unpacked payload
+_MANIFEST_SUMS = '.benchkit-manifest'
+_TIMED_OUT = 'benchkit: timed out, output is partial'
+
+# run on the receiving host, pulls the payload from a host which already
+# has it; prints the transfer time in nanoseconds.
+# Requires the VMs to be able to authenticate to each other without
+# interaction (e.g. shared keys or forwarded agent).
+# The payload is renamed once complete: a relay which outlives its timeout
+# never clobbers the payload uploaded by the fallback.
+_RELAY_CMD = (
+    'begin=$(/usr/bin/date +%s%N); '
+    '/usr/bin/scp -q -o BatchMode=yes -o StrictHostKeyChecking=no '
+    '{user}@{src}:{path} {path}.part || exit $?; '
+    '/usr/bin/mv -f {path}.part {path} || exit $?; '
+    'end=$(/usr/bin/date +%s%N); '
+    'echo $((end - begin))'
+)
 
 
 def configure():
@@ -38,20 +85,125 @@ def configure():
                         help="payload root directory on benchmarked VMs")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="increase the verbosiness")
+    parser.add_argument("-s", "--stream", type=str, default="none",
+                        choices=_STREAM_MODES,
+                        help="write the payload output on disk as it arrives:"
+                        " one file per host ('host') or a single file with"
+                        " lines tagged by host ('tagged')")
+    parser.add_argument("-d", "--distribute", type=str, default="copy",
+                        choices=_DISTRIBUTE_MODES,
+                        help="upload the payload from this host to all the"
+                        " VMs ('copy') or to few seed VMs which relay it to"
+                        " the others ('tree')")
+    parser.add_argument("--seeds", type=int, default=2,
+                        help="number of VMs this host uploads the payload to"
+                        " in 'tree' distribution mode")
+    parser.add_argument("--fanout", type=int, default=1,
+                        help="number of VMs each VM relays the payload to"
+                        " on each round in 'tree' distribution mode")
+    parser.add_argument("--relay-timeout", type=int, default=0,
+                        help="time (seconds) to wait for each round of relays"
+                        " in 'tree' distribution mode; the VMs which did not"
+                        " get the payload in time get it uploaded directly"
+                        " - use 0 to disable")
+    parser.add_argument("-C", "--no-cache", action="store_true",
+                        help="always upload and unpack the payload, even if"
+                        " already unpacked on the VMs")
+    parser.add_argument("-p", "--pipeline", action="store_true",
+                        help="let each VM go through the setup steps and run"
+                        " the payload on its own pace, instead of waiting"
+                        " for all the VMs at each step")
+    parser.add_argument("-b", "--barrier", action="store_true",
+                        help="in pipeline mode, wait for all the VMs to be"
+                        " set up before to run the payload")
+    parser.add_argument("-S", "--sync-start", type=float, default=0,
+                        help="start the payload on all the VMs at the same"
+                        " time, this many seconds after they are all set"
+                        " up - use 0 to disable")
+    parser.add_argument("-J", "--json-results", action="store_true",
+                        help="also write the results, one JSON object per"
+                        " host, in $BENCH_ID-results.jsonl")
+    parser.add_argument("-T", "--trace", type=str, default=None,
+                        help="write the timeline of the steps on each host"
+                        " in this file (Chrome trace event format)")
+    parser.add_argument("--run-timeout", type=int, default=0,
+                        help="time (seconds) to wait for the payload to"
+                        " complete on all the VMs - use 0 to disable")
+    parser.add_argument("--straggler-quantile", type=float, default=1.0,
+                        help="once this fraction of the VMs completed the"
+                        " payload, wait at most --straggler-grace seconds"
+                        " for the others")
+    parser.add_argument("--straggler-grace", type=int, default=0,
+                        help="time (seconds) the stragglers have to complete"
+                        " the payload, see --straggler-quantile")
+    parser.add_argument("-m", "--min-success", type=min_success_spec,
+                        default=None,
+                        help="consider the run succesfull if the payload"
+                        " succeeded on at least this many (N) or this"
+                        " percentage (N%%) of the VMs")
+    parser.add_argument("-w", "--sweep", type=str, default=None,
+                        help="YAML (or JSON) file mapping parameter names to"
+                        " lists of values, run the payload once for each"
+                        " combination")
+    parser.add_argument("-n", "--repeat", type=int, default=1,
+                        help="run the payload this many times (for each"
+                        " combination, in sweep mode)")
+    parser.add_argument("-P", "--pool-size", type=int, default=100,
+                        help="number of VMs to connect to, and to run"
+                        " commands on, concurrently")
+    parser.add_argument("-k", "--chunk-size", type=int, default=0,
+                        help="upload the payload in chunks of this size (MiB),"
+                        " resuming the upload of the missing or corrupted"
+                        " chunks - use 0 to disable")
+    parser.add_argument("--chunk-retries", type=int, default=3,
+                        help="times to retry the upload of the missing or"
+                        " corrupted chunks")
+    parser.add_argument("-z", "--wire-compression", type=str, default="gzip",
+                        choices=_WIRE_COMPRESSIONS,
+                        help="compression of the payload uploaded to the VMs;"
+                        " 'zstd' recompresses gzip payloads (once, kept in"
+                        " $XDG_CACHE_HOME/benchkit), and requires zstd on"
+                        " this host and on the VMs")
+    parser.add_argument("-M", "--manifest", type=str, default=None,
+                        help="payload manifest (see payloadlint --manifest),"
+                        " to verify the unpacked payload on the VMs before"
+                        " to run it")
     parser.add_argument("payload")
 
     return parser.parse_args(sys.argv[1:])
 
 
+def min_success_spec(value):
+    # N hosts, or N% of the hosts
+    try:
+        if value.endswith('%'):
+            valid = 0 <= float(value[:-1]) <= 100
+        else:
+            valid = int(value) >= 0
+    except ValueError:
+        valid = False
+    if not valid:
+        raise argparse.ArgumentTypeError(
+            'expected N or N%% (0-100), got %r' % value)
+    return value
+
+
 def check_auth(auth):
     for key in ('user', 'method', 'details'):
         if key not in auth:
             raise ValueError('malformed auth, missing key: %s' % key)
 
+    if auth['method'] not in _AUTH_METHODS:
+        raise ValueError('unsupported auth method: %s' % auth['method'])
+
     if auth['method'] == 'password':
         if 'password' not in auth['details']:
             raise ValueError('password auth set, but password field missing')
 
+    if auth['method'] == 'key':
+        if 'private_key' not in auth['details']:
+            raise ValueError('key auth set, but private_key field missing')
+
     return auth
 
 
@@ -89,28 +241,134 @@ def read_hosts(path):
     return ret
 
 
-def make_client(auth, hosts):
+def _auth_params(auth):
     if auth['method'] == 'password':
-        return ParallelSSHClient(
-            hosts.values(),
-            user=auth['user'],
-            password=auth['details']['password'])
+        return {
+            'user': auth['user'],
+            'password': auth['details']['password'],
+        }
+
+    if auth['method'] == 'key':
+        params = {
+            'user': auth['user'],
+            'pkey': os.path.expanduser(auth['details']['private_key']),
+            'allow_agent': False,
+        }
+        if 'passphrase' in auth['details']:
+            # used to decrypt the private key
+            params['password'] = auth['details']['passphrase']
+        return params
+
+    if auth['method'] == 'agent':
+        return {
+            'user': auth['user'],
+            'allow_agent': True,
+        }
 
     raise RuntimeError('unsupported auth method: %s' % auth['method'])
 
 
-def CommandFailed(RuntimeError):
+def make_client(auth, hosts, pool_size=None):
+    params = _auth_params(auth)
+    if pool_size is not None:
+        params['pool_size'] = pool_size
+    return ParallelSSHClient(hosts.values(), **params)
+
+
+class SessionPool:
+    # connects and authenticates to each host once: all the steps, and
+    # all the runs, reuse the same sessions.
+    def __init__(self, client):
+        self.client = client
+        self.unreachable = {}  # host -> error
+
+    @property
+    def hosts(self):
+        return list(self.client.hosts)
+
+    def connect(self, timeout, timings=None):
+        # each host is probed on its own, to time its connection setup;
+        # the connections land in the shared client anyway
+        begin = time.monotonic()
+        output = {}
+        jobs = gevent.pool.Pool(getattr(self.client, 'pool_size', None))
+
+        def _probe(host):
+            client = copy.copy(self.client)
+            client.hosts = [host]
+            start = time.time()
+            host_output = client.run_command(_PROBE_CMD, stop_on_errors=False)
+            client.join(host_output, timeout=timeout or None)
+            if timings is not None:
+                timings.record(host, 'connect', start, time.time())
+            output.update(host_output)
+
+        for host in self.client.hosts:
+            jobs.spawn(_probe, host)
+        jobs.join(raise_error=True)
+
+        reachable = []
+        for host in self.client.hosts:
+            host_output = output[host]
+            exc = getattr(host_output, 'exception', None)
+            if exc is None and host_output.exit_code == 0:
+                reachable.append(host)
+            else:
+                error = str(exc or 'exit code %s' % host_output.exit_code)
+                logging.warning('UNREACHABLE: %s (%s)', host, error)
+                self.unreachable[host] = error
+        logging.info('connected to %d/%d hosts in %.3fs', len(reachable),
+                     len(output), time.monotonic() - begin)
+        self.client.hosts = reachable
+        return reachable
+
+    def host_client(self, host):
+        return self.client.host_clients[host]
+
+
+class CommandFailed(RuntimeError):
     def __init__(self, host, output):
-        self.host
+        super().__init__(host, output)
+        self.host = host
         self._output = output
 
     def __str__(self):
         return "Failed on %s: %s" % (self.host, self._output)
 
 
-def run_hosts(client, cmd, timeout, info=None):
+def wait_hosts(output, wait):
+    # waits all the hosts concurrently, returns the time each one finished at
+    def _wait(host, host_output):
+        wait(host, host_output)
+        return time.time()
+
+    jobs = {
+        host: gevent.spawn(_wait, host, host_output)
+        for host, host_output in output.items()
+    }
+    gevent.joinall(list(jobs.values()), raise_error=True)
+    return {host: job.value for host, job in jobs.items()}
+
+
+def lockstep_waiter(client):
+    def wait(host, host_output):
+        client.join({host: host_output})
+    return wait
+
+
+def pipelined_waiter(host, host_output):
+    host_output.join()
+
+
+def run_hosts(client, cmd, timeout, info=None, timings=None, stage=None):
+    begin = time.time()
     output = client.run_command(cmd)
-    client.join(output, timeout=timeout)   # will raise Timeout
+    with gevent.Timeout(timeout or None, exception=Timeout):
+        ends = wait_hosts(output, lockstep_waiter(client))
+
+    if timings is not None:
+        for host, end in ends.items():
+            timings.record(host, stage, begin, end)
 
     for host, host_output in output.items():
         if host_output.exit_code != 0:
@@ -126,53 +384,1180 @@ def write_report(name, content):
             dst.write('%s\n' % data)
 
 
-def process_output(output, bench_id):
-    result, errors = {}, {}
-    for host, host_output in output.items():
-        if host_output.exit_code == 0:
-            result[host] = '\n'.join(host_output.stdout)
+class Timings:
+    def __init__(self):
+        self._spans = {}  # host -> stage -> (begin, end)
+
+    def record(self, host, stage, begin, end):
+        self._spans.setdefault(host, {})[stage] = (begin, end)
+
+    @contextlib.contextmanager
+    def span(self, hosts, stage):
+        begin = time.time()
+        yield
+        end = time.time()
+        for host in hosts:
+            self.record(host, stage, begin, end)
+
+    def stages(self, host):
+        return dict(self._spans.get(host, {}))
+
+    def durations(self):
+        ret = {}  # stage -> [duration, ...]
+        for stages in self._spans.values():
+            for stage, (begin, end) in stages.items():
+                if end is not None:
+                    ret.setdefault(stage, []).append(end - begin)
+        return ret
+
+    def trace_events(self):
+        # see the "Trace Event Format" document; a thread per host
+        events = []
+        for tid, host in enumerate(sorted(self._spans), 1):
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                'args': {'name': host},
+            })
+            for stage, (begin, end) in self._spans[host].items():
+                if end is None:
+                    continue
+                events.append({
+                    'name': stage, 'cat': 'runbench', 'ph': 'X',
+                    'pid': 1, 'tid': tid,
+                    'ts': int(begin * 1e6), 'dur': int((end - begin) * 1e6),
+                    'args': {'host': host},
+                })
+        return events
+
+
+def percentile(values, pct):
+    # nearest rank
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100. * len(ordered))))
+    return ordered[rank - 1]
+
+
+def log_summary(timings):
+    for stage, durations in sorted(timings.durations().items()):
+        logging.info('stage %s: p50=%.3fs p95=%.3fs max=%.3fs (%d hosts)',
+                     stage, percentile(durations, 50),
+                     percentile(durations, 95), max(durations),
+                     len(durations))
+
+
+def write_trace(path, timings):
+    with open(path, 'wt') as dst:
+        json.dump({
+            'traceEvents': timings.trace_events(),
+            'displayTimeUnit': 'ms',
+        }, dst)
+
+
+class Results:
+    def __init__(self, path, bench_id, digest, timings):
+        self._dst = open(path, 'wt')
+        self._bench_id = bench_id
+        self._digest = digest
+        self._timings = timings
+        self.context = {}  # extra fields to add to each record
+
+    def add(self, host, exit_code, stdout=None, stderr=None,
+            timed_out=False, clock_offset=None, start_skew=None):
+        stages = {
+            stage: (begin, end)
+            for stage, (begin, end) in self._timings.stages(host).items()
+            if end is not None
+        }
+        spans = stages.values()
+        record = {
+            'bench_id': self._bench_id,
+            'host': host,
+            'payload_digest': self._digest,
+            'exit_code': exit_code,
+            'stdout': stdout,
+            'stderr': stderr,
+            'timed_out': timed_out,
+            'clock_offset': clock_offset,
+            'start_skew': start_skew,
+            'start': min((begin for begin, _ in spans), default=None),
+            'end': max((end for _, end in spans), default=None),
+            'stages': {
+                stage: end - begin
+                for stage, (begin, end) in stages.items()
+            },
+        }
+        record.update(self.context)
+        self._dst.write('%s\n' % json.dumps(record, sort_keys=True))
+        self._dst.flush()
+
+    def close(self):
+        self._dst.close()
+
+
+def min_success_count(spec, total):
+    if spec is None:
+        return total
+    if spec.endswith('%'):
+        return int(math.ceil(float(spec[:-1]) / 100. * total))
+    return int(spec)
+
+
+class Report:
+    # writes the outcome of each host as soon as it is known
+    def __init__(self, bench_id, results=None, min_success=None):
+        self._bench_id = bench_id
+        self._results = results
+        self._min_success = min_success
+        self._files = {}
+        self.succeeded, self.failed, self.timed_out = [], [], []
+
+    def _write(self, kind, host, data, note=None):
+        if kind not in self._files:
+            self._files[kind] = open('%s-%s' % (self._bench_id, kind), 'wt')
+        dst = self._files[kind]
+        if note is None:
+            dst.write('### %s\n' % host)
+        else:
+            dst.write('### %s (%s)\n' % (host, note))
+        if data is not None:
+            dst.write('%s\n' % data)
+        dst.flush()
+
+    def add(self, host, exit_code, stdout=None, stderr=None,
+            timed_out=False, clock_offset=None, start_skew=None):
+        # stdout and stderr are None if already streamed on disk
+        if self._results is not None:
+            self._results.add(host, exit_code, stdout, stderr, timed_out,
+                              clock_offset, start_skew)
+
+        if timed_out:
+            self.timed_out.append(host)
+            logging.warning('TIMEOUT: %s', host)
+            self._write('errors', host,
+                        _TIMED_OUT if not stderr else
+                        '%s\n%s' % (stderr, _TIMED_OUT),
+                        'timed out')
+        elif exit_code == 0:
+            self.succeeded.append(host)
+            if stdout is not None:
+                self._write('result', host, stdout)
         else:
-            errors[host] = '\n'.join(host_output.stderr)
+            self.failed.append(host)
+            logging.warning('FAILED: %s (exit code %s)', host, exit_code)
+            # in streaming mode the errors are already on disk, still
+            # record the exit code
+            self._write('errors', host, stderr, 'exit code %s' % exit_code)
+
+    def add_unreachable(self, host, error):
+        if self._results is not None:
+            self._results.add(host, None, stderr=error)
+        self.failed.append(host)
+        self._write('errors', host, error, 'unreachable')
+
+    @property
+    def status(self):
+        total = len(self.succeeded) + len(self.failed) + len(self.timed_out)
+        needed = total if self._min_success is None else self._min_success
+        logging.info('%d/%d hosts succeeded (%d failed, %d timed out,'
+                     ' %d needed)', len(self.succeeded), total,
+                     len(self.failed), len(self.timed_out), needed)
+        return 0 if len(self.succeeded) >= needed else -1
+
+    def close(self):
+        for dst in self._files.values():
+            dst.close()
+
+
+def _drain(lines, sink):
+    for line in lines:
+        sink(line)
 
-    if errors:
-        write_report('%s-errors' % bench_id, errors)
-        return -1
 
-    write_report('%s-result' % bench_id, result)
-    return 0
+def _line_writer(dst, tag=None):
+    if tag is None:
+        return lambda line: dst.write('%s\n' % line)
+    return lambda line: dst.write('%s %s\n' % (tag, line))
 
 
-def upload_payload(client, src_path, dst_dir):
+class StreamFiles:
+    # the per host files of the 'host' streaming mode: each one is opened
+    # on its first line, and at most max_open are open at once; the least
+    # recently written is closed, and reopened for append if needed.
+    def __init__(self, max_open=_MAX_STREAM_FILES):
+        self._max_open = max_open
+        self._open = collections.OrderedDict()  # path -> file
+        self._created = set()
+
+    def writer(self, path):
+        return lambda line: self.write(path, line)
+
+    def write(self, path, line):
+        dst = self._open.pop(path, None)
+        if dst is None:
+            if len(self._open) >= self._max_open:
+                _, lru = self._open.popitem(last=False)
+                lru.close()
+            dst = open(path, 'at' if path in self._created else 'wt',
+                       buffering=1)
+            self._created.add(path)
+        self._open[path] = dst
+        dst.write('%s\n' % line)
+
+    def close(self):
+        while self._open:
+            _, dst = self._open.popitem()
+            dst.close()
+
+
+class Collector:
+    # drains the output of the hosts as it arrives, in memory or, in the
+    # streaming modes, on disk.
+    def __init__(self, output, bench_id, mode='none',
+                 max_open=_MAX_STREAM_FILES):
+        self._files = []
+        self._jobs = {}  # host -> [job, ...]
+        self._lines = {}  # host -> (stdout, stderr)
+        self._streams = StreamFiles(max_open)
+        tagged = self._open('%s-stream' % bench_id) if mode == 'tagged' else None
+        for host, host_output in output.items():
+            if mode == 'none':
+                out, err = [], []
+                self._lines[host] = (out, err)
+                sinks = (out.append, err.append)
+            elif mode == 'tagged':
+                sinks = (_line_writer(tagged, '[%s]' % host),
+                         _line_writer(tagged, '[%s!]' % host))
+            else:
+                sinks = (
+                    self._streams.writer('%s-result-%s' % (bench_id, host)),
+                    self._streams.writer('%s-errors-%s' % (bench_id, host)),
+                )
+            self._jobs[host] = [
+                gevent.spawn(_drain, host_output.stdout, sinks[0]),
+                gevent.spawn(_drain, host_output.stderr, sinks[1]),
+            ]
+
+    def _open(self, path):
+        # line buffered, so the content hits the disk as soon as the line
+        # is received, and we never hold more than a line per host in memory
+        dst = open(path, 'wt', buffering=1)
+        self._files.append(dst)
+        return dst
+
+    def join(self, host):
+        gevent.joinall(self._jobs[host], raise_error=True)
+
+    def stop(self, host):
+        gevent.killall(self._jobs[host])
+
+    def text(self, host):
+        if host not in self._lines:
+            return None, None
+        out, err = self._lines[host]
+        return '\n'.join(out), '\n'.join(err)
+
+    def close(self):
+        for jobs in self._jobs.values():
+            gevent.killall(jobs)
+        for dst in self._files:
+            dst.close()
+        self._streams.close()
+
+
+def upload_payload(client, src_path, dst_dir, timings=None):
     payload = os.path.basename(src_path)
     dst_path = os.path.join(dst_dir, payload)
     logging.info('%s -> %s', src_path, dst_path)
-    cmds = client.copy_file(src_path, dst_path)
-    gevent.joinall(cmds, raise_error=True)
+    spans = _copy_timed(client, src_path, dst_path)
+    if timings is not None:
+        for host, (begin, end) in spans.items():
+            timings.record(host, 'upload', begin, end)
+    return dst_path
+
+
+def payload_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _mkdir_cmd(root):
+    return '/usr/bin/mkdir -p %s' % root
+
+
+def _stamp_cmd(root):
+    stamp = os.path.join(root, _PAYLOAD_STAMP)
+    return '/usr/bin/cat %s 2>/dev/null || true' % stamp
+
+
+def _tar_flags(payload):
+    if payload.endswith(_ZSTD_SUFFIXES):
+        return '-x --use-compress-program=/usr/bin/zstd'
+    return 'xz'
+
+
+def _unpack_cmd(root, payload, digest):
+    # stamp only once done
+    stamp = os.path.join(root, _PAYLOAD_STAMP)
+    return ('/usr/bin/rm -f {stamp} && '
+            '/usr/bin/tar {flags} -C {root} -f {payload} && '
+            'echo {digest} > {stamp}'.format(
+                root=root, payload=payload, stamp=stamp, digest=digest,
+                flags=_tar_flags(payload)))
+
+
+def recompress_zstd(src_path, dst_dir):
+    name = os.path.basename(src_path)
+    for suffix in _GZIP_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    dst_path = os.path.join(dst_dir, name + '.tar.zst')
+    with open(dst_path, 'wb') as dst:
+        gunzip = subprocess.Popen(['gzip', '-dc', src_path],
+                                  stdout=subprocess.PIPE)
+        ret = subprocess.run(['zstd', '-q', '-T0', '-c'],
+                             stdin=gunzip.stdout, stdout=dst)
+        gunzip.stdout.close()
+        if gunzip.wait() != 0 or ret.returncode != 0:
+            raise RuntimeError('cannot recompress %s' % src_path)
+    logging.info('%s -> %s (%d -> %d bytes)', src_path, dst_path,
+                 os.path.getsize(src_path), os.path.getsize(dst_path))
+    return dst_path
+
+
+def _cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'benchkit')
+
+
+def cached_zstd(src_path, digest, cache_dir):
+    # the recompressed payload is kept across runs, keyed by the digest of
+    # the original, so a payload cached on the VMs costs nothing locally
+    dst_dir = os.path.join(cache_dir, digest)
+    name = os.path.basename(src_path)
+    for suffix in _GZIP_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    dst_path = os.path.join(dst_dir, name + '.tar.zst')
+    if os.path.exists(dst_path):
+        logging.info('%s: using the recompressed %s', src_path, dst_path)
+        return dst_path
+    os.makedirs(dst_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=dst_dir)
+    try:
+        # renamed once complete: an interrupted run leaves no partial file
+        os.rename(recompress_zstd(src_path, tmp_dir), dst_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return dst_path
+
+
+def split_payload(src_path, dst_dir, chunk_size):
+    chunks = []  # (name, digest)
+    with open(src_path, 'rb') as src:
+        for index, data in enumerate(iter(lambda: src.read(chunk_size), b'')):
+            name = '%06d' % index
+            with open(os.path.join(dst_dir, name), 'wb') as dst:
+                dst.write(data)
+            chunks.append((name, hashlib.sha256(data).hexdigest()))
+    return chunks
+
+
+def _check_chunks_cmd(chunk_dir, chunks):
+    # prints 'NAME: OK' for each chunk already there and sound
+    lines = ' '.join(
+        shlex.quote('%s  %s' % (digest, name)) for name, digest in chunks)
+    return ("/usr/bin/mkdir -p {dir} && cd {dir} && "
+            "/usr/bin/printf '%s\\n' {lines} | "
+            "/usr/bin/sha256sum -c 2>/dev/null || true".format(
+                dir=chunk_dir, lines=lines))
+
+
+def _join_chunks_cmd(chunk_dir, chunks, dst_path, digest):
+    return ("cd {dir} && /usr/bin/cat {names} > {dst} && "
+            "echo {check} | /usr/bin/sha256sum -c --status && "
+            "cd / && /usr/bin/rm -rf {dir}".format(
+                dir=chunk_dir, dst=dst_path,
+                names=' '.join(name for name, _ in chunks),
+                check=shlex.quote('%s  %s' % (digest, dst_path))))
+
+
+def verified_chunks(lines):
+    return set(
+        line[:-len(': OK')] for line in lines if line.endswith(': OK')
+    )
+
+
+def find_missing_chunks(client, chunk_dir, chunks, timeout):
+    output = client.run_command(_check_chunks_cmd(chunk_dir, chunks))
+    client.join(output, timeout=timeout or None)
+
+    ret = {}
+    for host, host_output in output.items():
+        verified = verified_chunks(host_output.stdout)
+        missing = [name for name, _ in chunks if name not in verified]
+        if missing:
+            ret[host] = missing
+    return ret
+
+
+def upload_chunked(client, src_path, dst_dir, chunk_size, retries, timeout,
+                   timings=None):
+    payload = os.path.basename(src_path)
+    dst_path = os.path.join(dst_dir, payload)
+    digest = payload_digest(src_path)
+    chunk_dir = os.path.join(dst_dir, _CHUNKS_DIR, digest)
+    hosts = list(client.hosts)
+    begin = time.time()
+
+    with tempfile.TemporaryDirectory(prefix='benchkit-') as workdir:
+        chunks = split_payload(src_path, workdir, chunk_size)
+        logging.info('%s -> %s (%d chunks)', src_path, dst_path, len(chunks))
+
+        pending = hosts
+        for attempt in range(retries + 1):
+            with restricted(client, pending):
+                missing = find_missing_chunks(
+                    client, chunk_dir, chunks, timeout)
+            if not missing:
+                break
+            if attempt == retries:
+                host = sorted(missing)[0]
+                raise CommandFailed(
+                    host, '%d chunks missing after %d retries' % (
+                        len(missing[host]), retries))
+
+            logging.info('upload: %d hosts miss %d chunks', len(missing),
+                         sum(len(names) for names in missing.values()))
+            for name, _ in chunks:
+                targets = [host for host, names in missing.items()
+                           if name in names]
+                if not targets:
+                    continue
+                with restricted(client, targets):
+                    # errors are caught by the next check
+                    gevent.joinall(client.copy_file(
+                        os.path.join(workdir, name),
+                        os.path.join(chunk_dir, name)))
+            pending = list(missing)
+
+    run_hosts(client, _join_chunks_cmd(chunk_dir, chunks, dst_path, digest),
+              timeout)
+    if timings is not None:
+        end = time.time()
+        for host in hosts:
+            timings.record(host, 'upload', begin, end)
+    return dst_path
+
+
+def load_manifest(path):
+    with open(path, 'rt') as src:
+        manifest = json.load(src)
+    try:
+        return [
+            (entry['sha256'], entry['name'])
+            for entry in manifest['files']
+            if entry['type'] == 'file'
+        ]
+    except (KeyError, TypeError) as exc:
+        raise ValueError('malformed manifest %s: %s' % (path, exc))
+
+
+def write_manifest_sums(path, sums):
+    # the sha256sum check file format
+    with open(path, 'wt') as dst:
+        for digest, name in sums:
+            dst.write('%s  %s\n' % (digest, name))
+
+
+def _verify_cmd(root):
+    return ('cd {root} && '
+            '/usr/bin/sha256sum -c --quiet --strict {sums}'.format(
+                root=root, sums=_MANIFEST_SUMS))
+
+
+def verify_payload(client, sums_path, root, timeout, timings=None):
+    hosts = list(client.hosts)
+    begin = time.time()
+    _copy_timed(client, sums_path, os.path.join(root, _MANIFEST_SUMS))
+    run_hosts(client, _verify_cmd(root), timeout)
+    if timings is not None:
+        end = time.time()
+        for host in hosts:
+            timings.record(host, 'verify', begin, end)
+
+
+def _env_vars(env):
+    if not env:
+        return ''
+    return ''.join(
+        ' %s=%s' % (name, shlex.quote(str(value)))
+        for name, value in sorted(env.items())
+    )
+
+
+def _payload_cmd(root, start_at=None, env=None):
+    # the payload runs in its own session, whose process group is recorded
+    # so _kill_cmd can stop the payload along with all its children
+    run = ('/usr/bin/setsid -w /usr/bin/env BENCH_ROOT={root}{env} /bin/sh -c '
+           '\'echo $$ > "$BENCH_ROOT"/{pgid} && exec "$BENCH_ROOT"/payload.sh\'')
+    if start_at is None:
+        return ('cd {root} && ' + run).format(
+            root=root, env=_env_vars(env), pgid=_PGID_STAMP)
+    # start_at is in the remote clock
+    return ('/usr/bin/sleep $(/usr/bin/awk -v at={at:.6f} -v now=$({clock}) '
+            '\'BEGIN {{ d = at - now; print (d > 0 ? d : 0) }}\') && '
+            '{clock} > {stamp} && cd {root} && ' + run).format(
+                root=root, at=start_at, clock=_CLOCK_CMD, pgid=_PGID_STAMP,
+                env=' BENCH_START_AT=%.6f%s' % (start_at, _env_vars(env)),
+                stamp=os.path.join(root, _STARTED_STAMP))
+
+
+def _started_cmd(root):
+    return '/usr/bin/cat %s' % os.path.join(root, _STARTED_STAMP)
+
+
+def _parse_time(lines):
+    try:
+        return float(list(lines)[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _is_cached(lines, digest):
+    return digest in [line.strip() for line in lines]
+
+
+def find_uncached(client, root, digest, timeout):
+    output = client.run_command(_stamp_cmd(root))
+    client.join(output, timeout=timeout)
+
+    return [
+        host for host, host_output in output.items()
+        if not _is_cached(host_output.stdout, digest)
+    ]
+
+
+@contextlib.contextmanager
+def restricted(client, hosts):
+    # the connections to the hosts are kept by the client, so running
+    # commands on a subset of the hosts does not reconnect.
+    saved = client.hosts
+    client.hosts = list(hosts)
+    try:
+        yield client
+    finally:
+        client.hosts = saved
+
+
+def _finish_time(job):
+    job.get()  # will reraise
+    return time.time()
+
+
+def _copy_timed(client, src_path, dst_path):
+    begin = time.time()
+    jobs = [
+        gevent.spawn(_finish_time, cmd)
+        for cmd in client.copy_file(src_path, dst_path)
+    ]
+    gevent.joinall(jobs, raise_error=True)
+    return {
+        host: (begin, job.value)
+        for host, job in zip(client.hosts, jobs)
+    }
+
+
+def _log_hop(src, dst, size, elapsed):
+    rate = size / elapsed / 1024. / 1024. if elapsed > 0 else float('inf')
+    logging.info('hop %s -> %s: %.3fs (%.2f MiB/s)', src, dst, elapsed, rate)
+
+
+def next_hops(have, missing, fanout):
+    hops, missing = [], list(missing)
+    for src in have:
+        for _ in range(fanout):
+            if not missing:
+                return hops, missing
+            hops.append((src, missing.pop(0)))
+    return hops, missing
+
+
+def relay_payload(client, user, hops, path, timeout):
+    cmds = tuple(
+        _RELAY_CMD.format(user=user, src=src, path=path)
+        for src, _ in hops
+    )
+    with restricted(client, [dst for _, dst in hops]):
+        output = client.run_command('%s', host_args=cmds,
+                                    stop_on_errors=False)
+        try:
+            client.join(output, timeout=timeout or None)
+        except Timeout:
+            # the unfinished hops have no exit code, thus fail below
+            logging.warning('relay timed out after %ss', timeout)
+
+    done = {}
+    for src, dst in hops:
+        host_output = output[dst]
+        if host_output.exit_code is None:
+            logging.warning('hop %s -> %s: timed out', src, dst)
+            continue
+        if host_output.exit_code != 0:
+            logging.warning('hop %s -> %s: failed (exit code %s)',
+                            src, dst, host_output.exit_code)
+            continue
+        try:
+            done[dst] = int(list(host_output.stdout)[-1]) / 1e9
+        except (IndexError, ValueError):
+            done[dst] = 0.  # succeeded, but we don't know how fast
+    return done
+
+
+def distribute_payload(client, user, src_path, dst_dir, seeds, fanout,
+                       timeout, timings=None):
+    if timings is None:
+        timings = Timings()
+    payload = os.path.basename(src_path)
+    dst_path = os.path.join(dst_dir, payload)
+    size = os.path.getsize(src_path)
+    hosts = list(client.hosts)
+    have, missing = hosts[:max(1, seeds)], hosts[max(1, seeds):]
+    logging.info('%s -> %s (tree, %d seeds)', src_path, dst_path, len(have))
+
+    with restricted(client, have):
+        for host, (begin, end) in _copy_timed(
+                client, src_path, dst_path).items():
+            _log_hop('localhost', host, size, end - begin)
+            timings.record(host, 'upload', begin, end)
+
+    failed = []
+    while missing:
+        hops, missing = next_hops(have, missing, max(1, fanout))
+        begin = time.time()
+        done = relay_payload(client, user, hops, dst_path, timeout)
+        for src, dst in hops:
+            if dst in done:
+                _log_hop(src, dst, size, done[dst])
+                timings.record(dst, 'upload', begin, begin + done[dst])
+                have.append(dst)
+            else:
+                failed.append(dst)
+
+    if failed:
+        # fallback: upload from here, like the 'copy' mode does
+        logging.warning('relay failed on %d hosts, uploading directly',
+                        len(failed))
+        with restricted(client, failed):
+            for host, (begin, end) in _copy_timed(
+                    client, src_path, dst_path).items():
+                _log_hop('localhost', host, size, end - begin)
+                timings.record(host, 'upload', begin, end)
+
     return dst_path
 
 
+class HostOutput:
+    # the outcome of the payload run on a single host, quacks like
+    # the host output of ParallelSSHClient.
+    def __init__(self, stdout, stderr, exit_code=None,
+                 host_client=None, channel=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.host_client = host_client
+        self.channel = channel
+
+    def join(self):
+        if self.channel is None or self.exit_code is not None:
+            return
+        self.host_client.wait_finished(self.channel)
+        self.exit_code = self.host_client.get_exit_status(self.channel)
+
+
+class Barrier:
+    def __init__(self, parties):
+        self._left = parties
+        self._event = gevent.event.Event()
+
+    def leave(self):
+        self._left -= 1
+        if self._left <= 0:
+            self._event.set()
+
+    def wait(self):
+        self.leave()
+        self._event.wait()
+
+
+class SyncStart:
+    def __init__(self, lead):
+        self.lead = lead
+        self.start_at = None  # local clock
+        self.clocks = {}  # host -> (offset, rtt)
+
+    def measure(self, host_client, samples=3):
+        # the sample with the shortest round trip is the most accurate
+        best = None
+        for _ in range(samples):
+            before = time.time()
+            remote = _parse_time(_host_exec(host_client, _CLOCK_CMD))
+            after = time.time()
+            if remote is None:
+                continue
+            rtt = after - before
+            if best is None or rtt < best[1]:
+                best = (remote - (before + after) / 2., rtt)
+        if best is None:
+            raise RuntimeError('cannot read the clock of %s' % host_client.host)
+        self.clocks[host_client.host] = best
+
+    def reset(self):
+        self.start_at = None
+        self.clocks = {}
+
+    def release(self):
+        if self.start_at is None:
+            self.start_at = time.time() + self.lead
+        return self.start_at
+
+    def remote_start_at(self, host):
+        return self.start_at + self.clocks[host][0]
+
+    def skews(self, started):
+        # started: host -> time the payload started at, remote clock
+        return {
+            host: ts - self.clocks[host][0] - self.start_at
+            for host, ts in started.items()
+            if ts is not None and host in self.clocks
+        }
+
+
+def write_sync_report(name, sync, started):
+    skews = sync.skews(started)
+    content = {}
+    for host, (offset, rtt) in sorted(sync.clocks.items()):
+        skew = skews.get(host)
+        content[host] = 'offset=%+.6f rtt=%.6f skew=%s' % (
+            offset, rtt, 'unknown' if skew is None else '%+.6f' % skew)
+    write_report(name, content)
+    if skews:
+        logging.info('start skew: max %.6fs on %d hosts',
+                     max(abs(skew) for skew in skews.values()), len(skews))
+
+
+def read_started(host_client, root):
+    if host_client is None:
+        return None
+    try:
+        return _parse_time(
+            _host_exec(host_client, _started_cmd(root), _STOP_TIMEOUT))
+    except (CommandFailed, Timeout):
+        return None
+
+
+def _host_exec(host_client, cmd, timeout=None):
+    with gevent.Timeout(timeout or None, exception=Timeout):
+        channel, _, stdout, stderr, _ = host_client.run_command(cmd)
+        out, err = list(stdout), list(stderr)
+        host_client.wait_finished(channel)
+    exit_code = host_client.get_exit_status(channel)
+    if exit_code != 0:
+        raise CommandFailed(
+            host_client.host, '\n'.join(err) or 'exit code %s' % exit_code)
+    return out
+
+
+def pipeline_host(host_client, args, digest, barrier=None, sync=None,
+                  timings=None):
+    if timings is None:
+        timings = Timings()
+    host = host_client.host
+    payload = os.path.join(args.root, os.path.basename(args.payload))
+    # like in lockstep mode, the timeout bounds the commands, not the uploads
+    try:
+        with timings.span([host], 'mkdir'):
+            _host_exec(host_client, _mkdir_cmd(args.root), args.timeout)
+        with timings.span([host], 'check'):
+            stamp = _host_exec(host_client, _stamp_cmd(args.root),
+                               args.timeout)
+        if args.no_cache or not _is_cached(stamp, digest):
+            with timings.span([host], 'upload'):
+                host_client.copy_file(args.payload, payload)
+            with timings.span([host], 'extract'):
+                _host_exec(host_client,
+                           _unpack_cmd(args.root, payload, digest),
+                           args.timeout)
+        if args.manifest_sums is not None:
+            with timings.span([host], 'verify'):
+                host_client.copy_file(
+                    args.manifest_sums,
+                    os.path.join(args.root, _MANIFEST_SUMS))
+                _host_exec(host_client, _verify_cmd(args.root), args.timeout)
+        if sync is not None:
+            with timings.span([host], 'clock'):
+                sync.measure(host_client)
+    except (Exception, gevent.Timeout) as exc:
+        logging.warning('FAILED: %s setup (%s)', host_client.host, exc)
+        if barrier is not None:
+            barrier.leave()
+        return HostOutput([], ['setup failed: %s' % exc], exit_code=-1)
+
+    logging.info('OK: %s ready', host_client.host)
+    if barrier is not None:
+        barrier.wait()
+
+    start_at = None
+    if sync is not None:
+        sync.release()
+        start_at = sync.remote_start_at(host)
+    timings.record(host, 'run', time.time(), None)
+    channel, _, stdout, stderr, _ = host_client.run_command(
+        _payload_cmd(args.root, start_at))
+    return HostOutput(stdout, stderr,
+                      host_client=host_client, channel=channel)
+
+
+def run_pipelined(pool, args, digest, sync=None, timings=None):
+    host_ips = pool.hosts
+    # synchronized start needs all the hosts to be ready
+    need_barrier = args.barrier or sync is not None
+    barrier = Barrier(len(host_ips)) if need_barrier else None
+    jobs = [
+        gevent.spawn(pipeline_host, pool.host_client(host),
+                     args, digest, barrier, sync, timings)
+        for host in host_ips
+    ]
+    gevent.joinall(jobs, raise_error=True)
+    return {host: job.value for host, job in zip(host_ips, jobs)}
+
+
+def setup_lockstep(client, auth, args, digest, timings):
+    hosts = list(client.hosts)
+    # step 1: ensure all hosts are ready to accept commands
+    run_hosts(client, _mkdir_cmd(args.root), args.timeout,
+              timings=timings, stage='mkdir')
+    # step 2: skip the hosts which already have this payload unpacked
+    if args.no_cache:
+        targets = hosts
+    else:
+        with timings.span(hosts, 'check'):
+            targets = find_uncached(client, args.root, digest, args.timeout)
+        logging.info('payload cached on %d/%d hosts',
+                     len(hosts) - len(targets), len(hosts))
+
+    if targets:
+        with restricted(client, targets):
+            # step 3: upload the payload
+            if args.distribute == 'tree':
+                remote_payload = distribute_payload(
+                    client, auth['user'], args.payload, args.root,
+                    args.seeds, args.fanout, args.relay_timeout, timings)
+            elif args.chunk_size > 0:
+                remote_payload = upload_chunked(
+                    client, args.payload, args.root,
+                    args.chunk_size * 1024 * 1024, args.chunk_retries,
+                    args.timeout, timings)
+            else:
+                remote_payload = upload_payload(
+                    client, args.payload, args.root, timings)
+            # step 4: unpack the payload
+            run_hosts(client,
+                      _unpack_cmd(args.root, remote_payload, digest),
+                      args.timeout, timings=timings, stage='extract')
+    # step 5: check the unpacked payload, even if cached
+    if args.manifest_sums is not None:
+        verify_payload(client, args.manifest_sums, args.root, args.timeout,
+                       timings)
+
+
+def launch_lockstep(client, args, sync, timings, env=None):
+    hosts = list(client.hosts)
+    if sync is None:
+        cmds = None
+    else:
+        sync.reset()
+        with timings.span(hosts, 'clock'):
+            gevent.joinall([
+                gevent.spawn(sync.measure, client.host_clients[host])
+                for host in hosts
+            ], raise_error=True)
+        sync.release()
+        cmds = tuple(
+            _payload_cmd(args.root, sync.remote_start_at(host), env)
+            for host in hosts
+        )
+
+    begin = time.time()
+    for host in hosts:
+        timings.record(host, 'run', begin, None)
+    if cmds is None:
+        return client.run_command(_payload_cmd(args.root, env=env))
+    return client.run_command('%s', host_args=cmds)
+
+
+def run_lockstep(client, auth, args, digest, sync=None, timings=None):
+    if timings is None:
+        timings = Timings()
+    # steps 1-4: set up the hosts
+    setup_lockstep(client, auth, args, digest, timings)
+    # step 5: run the payload
+    return launch_lockstep(client, args, sync, timings)
+
+
+def load_sweep(path):
+    with open(path, 'rt') as src:
+        matrix = yaml.safe_load(src)
+    if not isinstance(matrix, dict):
+        raise ValueError('malformed sweep, expected a mapping')
+    for name, values in matrix.items():
+        if not str(name).isidentifier():
+            raise ValueError('malformed sweep, bad parameter name: %s' % name)
+        if not isinstance(values, list):
+            raise ValueError('malformed sweep, %s values not a list' % name)
+    names = sorted(matrix)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(matrix[name] for name in names))
+    ]
+
+
+def iteration_key(params, repetition):
+    key = '-'.join(
+        ['r%d' % repetition] +
+        ['%s=%s' % (name, params[name]) for name in sorted(params)]
+    )
+    return key.replace(os.sep, '_')
+
+
+def run_sweep(client, auth, args, digest, sync, timings, results,
+              unreachable=None):
+    # set up once, then run the payload many times on the same connections
+    setup_lockstep(client, auth, args, digest, timings)
+    combinations = load_sweep(args.sweep) if args.sweep else [{}]
+    ret = 0
+    for repetition in range(args.repeat):
+        for params in combinations:
+            key = iteration_key(params, repetition)
+            logging.info('iteration: %s', key)
+            iter_args = copy.copy(args)
+            iter_args.bench_id = '%s-%s' % (args.bench_id, key)
+            if results is not None:
+                results.context = {
+                    'params': params,
+                    'repetition': repetition,
+                }
+            env = dict(params, BENCH_REPETITION=repetition)
+            output = launch_lockstep(client, iter_args, sync, timings, env)
+            if collect_output(output, iter_args, lockstep_waiter(client),
+                              client.host_clients, timings, results,
+                              sync, unreachable) != 0:
+                ret = -1
+    return ret
+
+
+def _finish_run(ends, timings):
+    for host, end in ends.items():
+        begin, _ = timings.stages(host).get('run', (end, None))
+        timings.record(host, 'run', begin, end)
+
+
+def wait_stragglers(output, wait, on_done, timeout=0, quantile=1.0,
+                    grace=0):
+    # returns the hosts which did not complete in time
+    needed = int(math.ceil(quantile * len(output)))
+    completed = []
+    quorum = gevent.event.Event()
+
+    def _wait(host, host_output):
+        try:
+            wait(host, host_output)
+            on_done(host, host_output, time.time())
+        finally:
+            completed.append(host)
+            if len(completed) >= needed:
+                quorum.set()
+
+    jobs = {
+        host: gevent.spawn(_wait, host, host_output)
+        for host, host_output in output.items()
+    }
+    begin = time.monotonic()
+    deadline = timeout if timeout > 0 else None
+    if needed < len(jobs):
+        if quorum.wait(deadline):
+            left = None
+            if deadline is not None:
+                left = max(0, deadline - (time.monotonic() - begin))
+            gevent.joinall(list(jobs.values()),
+                           timeout=grace if left is None else min(grace, left))
+    else:
+        gevent.joinall(list(jobs.values()), timeout=deadline)
+
+    stragglers = [host for host, job in jobs.items() if not job.ready()]
+    gevent.killall([jobs[host] for host in stragglers])
+    for job in jobs.values():
+        if job.ready() and job.exception is not None:
+            raise job.exception
+    return stragglers
+
+
+def _kill_cmd(root):
+    # the whole process group: the benchmark tools the payload started
+    # would survive it otherwise
+    return '/usr/bin/pkill -g "$(/usr/bin/cat %s)"' % os.path.join(
+        root, _PGID_STAMP)
+
+
+def stop_payload(host_client, host_output, root):
+    if host_client is None:
+        return
+    try:
+        with gevent.Timeout(_STOP_TIMEOUT):
+            channel, _, _, _, _ = host_client.run_command(_kill_cmd(root))
+            host_client.wait_finished(channel)
+    except (Exception, gevent.Timeout) as exc:
+        logging.warning('cannot stop the payload on %s: %s',
+                        host_client.host, exc)
+    try:
+        host_client.close_channel(host_output.channel)
+    except Exception as exc:
+        logging.warning('cannot close the channel to %s: %s',
+                        host_client.host, exc)
+
+
+def collect_output(output, args, wait, host_clients, timings=None,
+                   results=None, sync=None, unreachable=None):
+    # unreachable: host -> error, the hosts we could not connect to;
+    # they count as failed
+    if timings is None:
+        timings = Timings()
+    if unreachable is None:
+        unreachable = {}
+    collector = Collector(output, args.bench_id, args.stream,
+                          _MAX_STREAM_FILES)
+    report = Report(args.bench_id, results,
+                    min_success_count(args.min_success,
+                                      len(output) + len(unreachable)))
+    for host, error in sorted(unreachable.items()):
+        report.add_unreachable(host, error)
+    started = {}  # host -> time the payload started at, remote clock
+
+    def _sync_fields(host):
+        if sync is None:
+            return {}
+        started[host] = read_started(host_clients.get(host), args.root)
+        offset, _ = sync.clocks.get(host, (None, None))
+        return {
+            'clock_offset': offset,
+            'start_skew': sync.skews({host: started[host]}).get(host),
+        }
+
+    def _wait(host, host_output):
+        wait(host, host_output)
+        # the output generators end when the payload does
+        collector.join(host)
+
+    def _done(host, host_output, end):
+        _finish_run({host: end}, timings)
+        stdout, stderr = collector.text(host)
+        report.add(host, host_output.exit_code, stdout, stderr,
+                   **_sync_fields(host))
+
+    try:
+        stragglers = wait_stragglers(
+            output, _wait, _done, args.run_timeout,
+            args.straggler_quantile, args.straggler_grace)
+        gevent.joinall([
+            gevent.spawn(stop_payload, host_clients.get(host),
+                         output[host], args.root)
+            for host in stragglers
+        ])
+        for host in stragglers:
+            collector.stop(host)
+            _finish_run({host: time.time()}, timings)
+            stdout, stderr = collector.text(host)
+            report.add(host, None, stdout, stderr, timed_out=True,
+                       **_sync_fields(host))
+        if sync is not None:
+            write_sync_report('%s-sync' % args.bench_id, sync, started)
+    finally:
+        collector.close()
+        report.close()
+
+    return report.status
+
+
 def runbench(args):
     logging.info('BENCH_ID=%s' % args.bench_id)
 
     hosts = read_hosts(args.hosts)
     auth = read_auth(args.auth_file)
-    client = make_client(auth, hosts)
+    digest = payload_digest(args.payload)
+    logging.info('PAYLOAD_DIGEST=%s' % digest)
 
-    # step 1: ensure all hosts are ready to accept commands
-    run_hosts(client, '/usr/bin/mkdir -p %s' % args.root, args.timeout)
-    # step 2: upload the payload
-    remote_payload = upload_payload(client, args.payload, args.root)
-    # step 3: unpack the payload
-    run_hosts(client, 
-              '/usr/bin/tar xz -C {root} -f {payload}'.format(
-                root=args.root, payload=remote_payload),
-               args.timeout)
-    # step 4: run the payload and collect the results
-    output = client.run_command(
-        'cd {root} && /usr/bin/env BENCH_ROOT={root} {root}/payload.sh'.format(root=args.root))
-    client.join(output)  # intentionally no timeout
-
-    return process_output(output, args.bench_id)
+    sync = SyncStart(args.sync_start) if args.sync_start > 0 else None
+    timings = Timings()
+    results = None
+    if args.json_results:
+        results = Results('%s-results.jsonl' % args.bench_id,
+                          args.bench_id, digest, timings)
+
+    workdir = tempfile.mkdtemp(prefix='benchkit-')
+    try:
+        if args.wire_compression == 'zstd' and \
+                not args.payload.endswith(_ZSTD_SUFFIXES):
+            # the digest, thus the cache, is still the one of the original
+            args = copy.copy(args)
+            args.payload = cached_zstd(args.payload, digest, _cache_dir())
+        args = copy.copy(args)
+        args.manifest_sums = None
+        if args.manifest is not None:
+            args.manifest_sums = os.path.join(workdir, 'manifest.sha256')
+            write_manifest_sums(args.manifest_sums,
+                                load_manifest(args.manifest))
+
+        pool = SessionPool(make_client(auth, hosts, args.pool_size))
+        pool.connect(args.timeout, timings)
+        client = pool.client
+
+        sweep = args.sweep is not None or args.repeat > 1
+        if args.pipeline and sweep:
+            logging.warning('sweep mode: ignoring --pipeline')
+        elif args.pipeline:
+            if args.distribute != 'copy':
+                logging.warning('pipeline mode: ignoring --distribute')
+            if args.chunk_size > 0:
+                logging.warning('pipeline mode: ignoring --chunk-size')
+            output = run_pipelined(pool, args, digest, sync, timings)
+            host_clients = {
+                host: host_output.host_client
+                for host, host_output in output.items()
+            }
+            return collect_output(output, args, pipelined_waiter,
+                                  host_clients, timings, results, sync,
+                                  pool.unreachable)
+
+        if sweep:
+            return run_sweep(client, auth, args, digest, sync, timings,
+                             results, pool.unreachable)
+
+        output = run_lockstep(client, auth, args, digest, sync, timings)
+        return collect_output(output, args, lockstep_waiter(client),
+                              client.host_clients, timings, results, sync,
+                              pool.unreachable)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if results is not None:
+            results.close()
+        log_summary(timings)
+        if args.trace is not None:
+            write_trace(args.trace, timings)
 
 
 def _main():
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# (C) 2018 Red Hat Inc.
+# License: Apache v2
+
+# Micro-benchmark of the VM definitions generation, not run by pytest:
+#   $ PYTHONPATH=scripts python tests/bench_vmdef.py [INSTANCES]
+
+import copy
+import sys
+import time
+
+import yaml
+
+import mkkvenv
+
+
+VM_MASTER_DEF = {
+    "apiVersion": "kubevirt.io/v1alpha2",
+    "kind": "VirtualMachine",
+    "metadata": {
+        "name": "benchvm",
+        "labels": {"app": "benchkit"},
+    },
+    "spec": {
+        "running": False,
+        "template": {
+            "metadata": {"labels": {"kubevirt.io/vm": "benchvm"}},
+            "spec": {
+                "domain": {
+                    "cpu": {"cores": 2},
+                    "resources": {"requests": {"memory": "2048M"}},
+                    "devices": {
+                        "disks": [
+                            {"name": "rootvolume", "volumeName": "rootvolume",
+                             "disk": {"bus": "virtio"}},
+                            {"name": "cloudinit", "volumeName": "cloudinit",
+                             "disk": {"bus": "virtio"}},
+                        ],
+                        "interfaces": [{"name": "default", "bridge": {}}],
+                    },
+                },
+                "networks": [{"name": "default", "pod": {}}],
+                "volumes": [
+                    {"name": "rootvolume",
+                     "persistentVolumeClaim": {"claimName": "benchpvc"}},
+                    {"name": "cloudinit",
+                     "cloudInitNoCloud": {
+                         "userData": "#cloud-config\npassword: fedora\n"
+                                     "chpasswd: { expire: False }\n"}},
+                ],
+            },
+        },
+    },
+}
+
+
+def deepcopy_dump(master_def, instances):
+    # the original path: deep copy, then pure-Python YAML emitter
+    ret = []
+    for ident in range(instances):
+        vm_def = copy.deepcopy(master_def)
+        vm_def["metadata"]["name"] = "%s-%i" % (
+            vm_def["metadata"]["name"], ident)
+        vol = vm_def["spec"]["template"]["spec"]["volumes"][0]
+        vol["persistentVolumeClaim"]["claimName"] = "%s-%i" % (
+            vol["persistentVolumeClaim"]["claimName"], ident)
+        ret.append(yaml.dump(vm_def))
+    return ret
+
+
+def template_dump(master_def, instances):
+    return [
+        vm_def.to_yaml()
+        for vm_def in mkkvenv.make_vm_defs(master_def, instances)
+    ]
+
+
+def measure(func, instances):
+    begin = time.perf_counter()
+    func(VM_MASTER_DEF, instances)
+    return time.perf_counter() - begin
+
+
+def _main():
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    assert [yaml.safe_load(text) for text in deepcopy_dump(VM_MASTER_DEF, 3)] \
+        == [yaml.safe_load(text) for text in template_dump(VM_MASTER_DEF, 3)]
+    for name, func in (("deepcopy+dump", deepcopy_dump),
+                       ("template", template_dump)):
+        elapsed = measure(func, instances)
+        print("%-14s N=%d: %8.3fs total, %8.1fus/instance" % (
+            name, instances, elapsed, elapsed / instances * 1e6))
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
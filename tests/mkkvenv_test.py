@@ -0,0 +1,805 @@
+#!/usr/bin/env python3
+# (C) 2018 Red Hat Inc.
+# License: Apache v2
+
+
+import argparse
+import copy
+import http.server
+import io
+import json
+import os
+import stat
+import textwrap
+import threading
+import time
+import urllib.parse
+
+import pytest
+import yaml
+
+import mkkvenv
+
+
+VM_MASTER_DEF = {
+    "apiVersion": "kubevirt.io/v1alpha2",
+    "kind": "VirtualMachine",
+    "metadata": {
+        "name": "testvm",
+    },
+    "spec": {
+        "running": False,
+        "template": {
+            "spec": {
+                "volumes": [
+                    {
+                        "name": "rootvolume",
+                        "persistentVolumeClaim": {
+                            "claimName": "testpvc",
+                        },
+                    },
+                ],
+            },
+        },
+    },
+}
+
+
+# fake kubectl: succeeds on every object, except the ones whose name
+# ends with '-1'
+FAKE_KUBECTL = textwrap.dedent("""\
+    #!/usr/bin/env python3
+    import sys
+    import yaml
+    args = sys.argv[1:]
+    if args[0] == 'patch':
+        names = args[2:args.index('--type')]
+    else:
+        names = [obj['metadata']['name'] for obj in yaml.safe_load_all(sys.stdin)]
+    rc = 0
+    for name in names:
+        if name.endswith('-1'):
+            sys.stderr.write('Error from server: %s\\n' % name)
+            rc = 1
+        else:
+            sys.stdout.write('virtualmachine.kubevirt.io/%s\\n' % name)
+    sys.exit(rc)
+""")
+
+
+@pytest.fixture
+def fake_cmd(tmpdir):
+    exe = os.path.join(tmpdir, "kubectl")
+    with open(exe, "wt") as f:
+        f.write(FAKE_KUBECTL)
+    os.chmod(exe, stat.S_IRWXU)
+    return mkkvenv.Cmd(exe)
+
+
+def test_vmdef_customize():
+    vm_def = mkkvenv.VMDef(VM_MASTER_DEF, 3)
+    assert vm_def.name == "testvm-3"
+    assert vm_def.rootvolume().claim_name == "testpvc-3"
+    # master definition untouched
+    assert VM_MASTER_DEF["metadata"]["name"] == "testvm"
+
+
+@pytest.mark.parametrize('action', [
+    mkkvenv.setup,
+    mkkvenv.start,
+    mkkvenv.teardown,
+])
+def test_bulk_partial_failure(fake_cmd, action):
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    done = action(fake_cmd, vm_defs, bulk=True)
+    assert [vm_def.name for vm_def in done] == ["testvm-0", "testvm-2"]
+
+
+def test_bulk_start(fake_cmd):
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    assert fake_cmd.start_many(vm_defs) == set(["testvm-0", "testvm-2"])
+
+
+class FakeRun:
+    def __init__(self, stdout=b''):
+        self.stdout = stdout
+        self.calls = []
+
+    def __call__(self, args, **kwargs):
+        self.calls.append(args)
+        return mkkvenv.subprocess.CompletedProcess(
+            args, 0, stdout=self.stdout, stderr=b'')
+
+
+def test_cmd_namespace(monkeypatch):
+    run = FakeRun(b'{"items": []}')
+    monkeypatch.setattr(mkkvenv.subprocess, 'run', run)
+    cmd = mkkvenv.make_cmd("kubectl", "bench")
+    cmd.get_pvcs()
+    cmd.start_many([mkkvenv.VMDef(VM_MASTER_DEF, 0)])
+    cmd.create(mkkvenv.VMDef(VM_MASTER_DEF, 0))
+    assert [args[:3] for args in run.calls] == [["kubectl", "-n", "bench"]] * 3
+    assert cmd.namespace == "bench"
+
+
+class FakePopen:
+    calls = []
+
+    def __init__(self, args, **kwargs):
+        self.calls.append(args)
+        self.stdout = io.BytesIO()
+
+    def poll(self):
+        return 0
+
+    def wait(self):
+        return 0
+
+
+@pytest.mark.parametrize('events,flags', [
+    (False, []),
+    (True, ["--output-watch-events"]),
+])
+def test_cmd_watch_events(monkeypatch, events, flags):
+    # only the teardown needs the deletions, and a recent kubectl
+    monkeypatch.setattr(mkkvenv.subprocess, 'Popen', FakePopen)
+    monkeypatch.setattr(FakePopen, 'calls', [])
+    cmd = mkkvenv.make_cmd("kubectl", "bench")
+    cmd.watch_pvcs(events=events).close()
+    assert FakePopen.calls == [
+        ["kubectl", "-n", "bench", "get", "pvc", "-o", "json", "--watch"] +
+        flags]
+
+
+@pytest.mark.parametrize('current,namespace', [
+    (b'bench', "bench"),
+    (b'', "default"),
+])
+def test_cmd_current_namespace(monkeypatch, current, namespace):
+    run = FakeRun(current)
+    monkeypatch.setattr(mkkvenv.subprocess, 'run', run)
+    cmd = mkkvenv.make_cmd("kubectl")
+    assert cmd.namespace == namespace
+    assert cmd.namespace == namespace
+    assert len(run.calls) == 1
+    assert mkkvenv.make_cmd("http://127.0.0.1:8001").namespace == "default"
+
+
+@pytest.mark.parametrize('buf,objs,rest', [
+    ('', [], ''),
+    ('{"a": 1}', [{"a": 1}], ''),
+    ('{"a": 1}\n{"b": ', [{"a": 1}], '{"b": '),
+    ('{"a": 1}{"b": 2}\n  ', [{"a": 1}, {"b": 2}], ''),
+])
+def test_split_json(buf, objs, rest):
+    assert mkkvenv.split_json(buf) == (objs, rest)
+
+
+def _pvc_obj(name, phase):
+    return {
+        "kind": "PersistentVolumeClaim",
+        "metadata": {
+            "name": name,
+            "annotations": {
+                "cdi.kubevirt.io/storage.import.pod.phase": phase,
+            },
+        },
+    }
+
+
+def test_watcher(tmpdir):
+    path = os.path.join(tmpdir, "events.json")
+    with open(path, "wt") as f:
+        f.write(json.dumps(_pvc_obj("pvc-0", "Running"), indent=2))
+        f.write(json.dumps(_pvc_obj("pvc-1", "Running"), indent=2))
+        f.write(json.dumps(_pvc_obj("pvc-0", "Succeeded"), indent=2))
+        f.write(json.dumps({
+            "type": "DELETED",
+            "object": _pvc_obj("pvc-1", "Running"),
+        }))
+
+    watcher = mkkvenv.Watcher(["cat", path], mkkvenv.PVC)
+    while watcher.alive:
+        watcher.wait_changed(1.0)
+    watcher.close()
+    pvcs = watcher.snapshot()
+    assert [(pvc.name, pvc.import_phase) for pvc in pvcs] == [
+        ("pvc-0", "Succeeded")
+    ]
+
+
+def _pod_obj(name, domain=None, ready=True, terminating=False):
+    obj = {
+        "kind": "Pod",
+        "metadata": {
+            "name": name,
+            "labels": {
+                "kubevirt.io": "virt-launcher",
+            },
+        },
+        "status": {
+            "podIP": "10.0.0.1",
+            "containerStatuses": [
+                {"ready": ready},
+            ],
+        },
+    }
+    if domain is not None:
+        obj["metadata"]["labels"]["kubevirt.io/domain"] = domain
+    if terminating:
+        obj["metadata"]["deletionTimestamp"] = "2018-10-01T10:00:00Z"
+    return obj
+
+
+@pytest.mark.parametrize('obj,domain', [
+    (_pod_obj("virt-launcher-testvm-1-abcde", "testvm-1"), "testvm-1"),
+    (_pod_obj("virt-launcher-testvm-1-abcde"), "testvm-1"),
+    (_pod_obj("virt-launcher-testvm-10-abcde"), "testvm-10"),
+    (_pod_obj("unrelated"), None),
+])
+def test_pod_domain(obj, domain):
+    assert mkkvenv.POD(obj).domain == domain
+
+
+def test_readiness_status_exact_match():
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in (1, 10)]
+    pods = [
+        mkkvenv.POD(_pod_obj(
+            "virt-launcher-testvm-10-abcde", "testvm-10", ready=True)),
+        mkkvenv.POD(_pod_obj(
+            "virt-launcher-testvm-1-fghij", "testvm-1", ready=False)),
+    ]
+    status = mkkvenv.Cmd("kubectl").readiness_status(vm_defs, pods)
+    assert status == {"testvm-1": False, "testvm-10": True}
+
+
+def test_index_pods_skips_terminating():
+    pods = [
+        mkkvenv.POD(_pod_obj(
+            "virt-launcher-testvm-1-abcde", "testvm-1", ready=True)),
+        mkkvenv.POD(_pod_obj(
+            "virt-launcher-testvm-1-fghij", "testvm-1", ready=False,
+            terminating=True)),
+    ]
+    index = mkkvenv.index_pods(pods)
+    assert index["testvm-1"].name == "virt-launcher-testvm-1-abcde"
+
+
+class FakeProvisionCmd:
+    def __init__(self, failing=(), namespace="default"):
+        self.applied = []
+        self._failing = failing
+        self.namespace = namespace
+
+    def get_pvcs(self):
+        return []
+
+    def add_pvc(self, pvc_obj, endpoint, image):
+        self.applied.append([pvc_obj.name])
+
+    def add_pvcs(self, pvc_objs, endpoint, image):
+        names = [pvc_obj.name for pvc_obj in pvc_objs]
+        self.applied.append(names)
+        return set(name for name in names if name not in self._failing)
+
+    def clone_pvc(self, pvc_obj, namespace, source):
+        pvc_obj.clone_from(namespace, source)
+        self.applied.append([pvc_obj.name])
+
+    def clone_pvcs(self, pvc_objs, namespace, source):
+        for pvc_obj in pvc_objs:
+            pvc_obj.clone_from(namespace, source)
+        return self.add_pvcs(pvc_objs, None, None)
+
+
+def test_find_image_size_memoized(monkeypatch):
+    calls = []
+
+    def _urlopen(url, timeout=None):
+        calls.append(url)
+        return io.StringIO('{"virtual-size": 4294967296}')
+
+    mkkvenv.find_image_size.cache_clear()
+    monkeypatch.setattr(mkkvenv.urllib.request, 'urlopen', _urlopen)
+    try:
+        for _ in range(3):
+            assert mkkvenv.find_image_size('http://img', 'a.qcow2') == 4
+        mkkvenv.find_image_size('http://img', 'b.qcow2')
+    finally:
+        mkkvenv.find_image_size.cache_clear()
+    assert calls == ['http://img/info/a.qcow2', 'http://img/info/b.qcow2']
+
+
+def test_provision_bulk(monkeypatch):
+    monkeypatch.setattr(mkkvenv, 'find_image_size', lambda *args: 10)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    cmd = FakeProvisionCmd(failing=("testpvc-1",))
+    provisioned = mkkvenv.provision(
+        cmd, vm_defs, 'http://img', 'disk.qcow2', bulk=True)
+    # a single apply for all the PVCs
+    assert cmd.applied == [["testpvc-0", "testpvc-1", "testpvc-2"]]
+    assert sorted(pvc.name for pvc in provisioned) == [
+        "testpvc-0", "testpvc-2"]
+
+
+def test_provision_golden_clone(monkeypatch):
+    monkeypatch.setattr(mkkvenv, 'find_image_size', lambda *args: 10)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(2)]
+    cmd = FakeProvisionCmd()
+    provisioned = mkkvenv.provision(
+        cmd, vm_defs, 'http://img', 'disk.qcow2',
+        golden=('default', 'golden'))
+    assert cmd.applied == [["testpvc-0"], ["testpvc-1"]]
+    for pvc in provisioned:
+        notes = pvc._def["metadata"]["annotations"]
+        assert notes == {"k8s.io/CloneRequest": "default/golden"}
+
+
+def test_provision_golden_namespace(monkeypatch):
+    monkeypatch.setattr(mkkvenv, 'find_image_size', lambda *args: 10)
+    golden_cmd = FakeProvisionCmd(namespace="images")
+    monkeypatch.setattr(
+        mkkvenv, 'make_cmd',
+        lambda command, namespace: golden_cmd if namespace == "images"
+        else None)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, 0)]
+    cmd = FakeProvisionCmd(namespace="bench")
+    args = argparse.Namespace(
+        command="kubectl", golden_pvc="golden", golden_namespace="images",
+        endpoint="http://img", image="disk.qcow2", bulk=False, timeout=0,
+        watch=False)
+    assert mkkvenv._provision(cmd, args, vm_defs)
+    # the golden PVC is imported in its namespace, and cloned from there
+    assert golden_cmd.applied == [["golden"]]
+    assert cmd.applied == [["testpvc-0"]]
+
+@pytest.mark.parametrize('notes,ready', [
+    ({}, False),
+    ({"cdi.kubevirt.io/storage.import.pod.phase": "Running"}, False),
+    ({"cdi.kubevirt.io/storage.import.pod.phase": "Succeeded"}, True),
+    ({"k8s.io/CloneRequest": "default/golden"}, False),
+    ({"cdi.kubevirt.io/storage.clone.pod.phase": "Succeeded"}, True),
+    ({"k8s.io/CloneOf": "true"}, True),
+])
+def test_pvc_ready(notes, ready):
+    pvc = mkkvenv.PVC({"metadata": {"name": "testpvc-0", "annotations": notes}})
+    assert pvc.ready == ready
+
+
+class FakePoolCmd:
+    def __init__(self, names):
+        self._vms = [
+            {"kind": "VirtualMachine", "metadata": {"name": name}}
+            for name in names
+        ]
+        self.selectors = []
+
+    def get_vms(self, selector):
+        self.selectors.append(selector)
+        return [mkkvenv.VMDef(vm) for vm in self._vms]
+
+
+def test_reconcile_pool():
+    cmd = FakePoolCmd(["testvm-0", "testvm-1", "testvm-5"])
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    to_add, warm, to_remove = mkkvenv.reconcile_pool(cmd, vm_defs, "bench")
+    assert cmd.selectors == ["benchkit.io/pool=bench"]
+    assert [vm_def.name for vm_def in to_add] == ["testvm-2"]
+    assert [vm_def.name for vm_def in warm] == ["testvm-0", "testvm-1"]
+    assert [vm.name for vm in to_remove] == ["testvm-5"]
+
+
+class FakeStartPoolCmd(FakePoolCmd):
+    # testvm-0 is running, testvm-1 is stopped and fails to start
+    def readiness_status(self, vm_defs):
+        return {"testvm-0": True}
+
+    def start_many(self, vm_defs):
+        return set()
+
+    def get_ips(self, vm_defs):
+        return {vm_def.name: "10.0.0.1" for vm_def in vm_defs}
+
+
+def test_run_pool_start_failure(tmpdir):
+    cmd = FakeStartPoolCmd(["testvm-0", "testvm-1"])
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(2)]
+    hosts_file = os.path.join(tmpdir, "hosts")
+    args = argparse.Namespace(
+        teardown_only=False, setup_only=False, provision_only=False,
+        bulk=True, timeout=0, watch=False, pool="bench",
+        hosts_file=hosts_file)
+    assert mkkvenv._run_pool(cmd, args, vm_defs) == 0
+    with open(hosts_file) as f:
+        assert f.read() == (
+            "# BEGIN 1 available VMs\n"
+            "10.0.0.1\t\ttestvm-0\n"
+            "# END 1 available VMs\n"
+        )
+
+
+class FakeGoneCmd:
+    # each listing drops the first object left
+    def __init__(self, vms, pods, pvcs):
+        self.vms, self.pods, self.pvcs = list(vms), list(pods), list(pvcs)
+
+    def _drain(self, items):
+        ret = list(items)
+        if items:
+            items.pop(0)
+        return ret
+
+    def get_vms(self, selector=None):
+        return [
+            mkkvenv.VMDef({"metadata": {"name": name}})
+            for name in self._drain(self.vms)
+        ]
+
+    def get_pods(self):
+        return [
+            mkkvenv.POD(_pod_obj("virt-launcher-" + name, domain=name))
+            for name in self._drain(self.pods)
+        ]
+
+    def get_pvcs(self):
+        return [
+            mkkvenv.PVC(_pvc_obj(name, "Succeeded"))
+            for name in self._drain(self.pvcs)
+        ]
+
+    def delete_pvcs(self, names):
+        return set(name for name in names if not name.endswith("-1"))
+
+
+def test_wait_gone(monkeypatch):
+    monkeypatch.setattr(mkkvenv, '_pause_any', lambda watchers, step: step)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(2)]
+    cmd = FakeGoneCmd(
+        ["testvm-0", "testvm-1"], ["testvm-0", "testvm-1"], ["testpvc-0"])
+    gone = mkkvenv.wait_gone(cmd, vm_defs, ["testpvc-0"], 60)
+    assert sorted(gone) == [
+        ("pod", "testvm-0"), ("pod", "testvm-1"), ("pvc", "testpvc-0"),
+        ("vm", "testvm-0"), ("vm", "testvm-1"),
+    ]
+    assert gone[("vm", "testvm-0")] <= gone[("vm", "testvm-1")]
+    assert gone[("pod", "testvm-0")] <= gone[("pod", "testvm-1")]
+
+
+def test_wait_gone_timeout(monkeypatch):
+    monkeypatch.setattr(mkkvenv, '_pause_any', lambda watchers, step: step)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, 0)]
+    cmd = FakeGoneCmd(["testvm-0"] * 100, [], [])
+    with pytest.raises(TimeoutError):
+        mkkvenv.wait_gone(cmd, vm_defs, [], 0)
+
+
+class FakeWatchGoneCmd(FakeGoneCmd):
+    # the VMs are listed forever, only their watch reports them gone
+    def __init__(self, path, vms, pods):
+        super().__init__([], pods, [])
+        self.path = path
+        self.listed = vms
+        self.listings = 0
+
+    def get_vms(self, selector=None):
+        self.listings += 1
+        return [mkkvenv.VMDef({"metadata": {"name": name}})
+                for name in self.listed]
+
+    def watch_vms(self, cond=None, events=False):
+        assert events
+        return mkkvenv.Watcher(
+            ["sh", "-c", "cat %s; exec sleep 60" % self.path],
+            mkkvenv.VMDef, cond=cond)
+
+    def watch_pods(self, cond=None, events=False):
+        raise RuntimeError("no watch")
+
+
+def test_wait_gone_watch(tmpdir):
+    path = os.path.join(tmpdir, "events.json")
+    vm_obj = {"kind": "VirtualMachine", "metadata": {"name": "testvm-0"}}
+    with open(path, "wt") as f:
+        f.write(json.dumps({"type": "ADDED", "object": vm_obj}))
+        f.write(json.dumps({"type": "DELETED", "object": vm_obj}))
+
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, 0)]
+    cmd = FakeWatchGoneCmd(path, ["testvm-0"], ["testvm-0"])
+    gone = mkkvenv.wait_gone(cmd, vm_defs, [], 10, watch=True)
+    assert sorted(gone) == [("pod", "testvm-0"), ("vm", "testvm-0")]
+    assert cmd.listings <= 2
+
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_delete_claims(bulk):
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    cmd = FakeGoneCmd([], [], [])
+    assert mkkvenv.delete_claims(cmd, vm_defs, bulk) == [
+        "testpvc-0", "testpvc-2"]
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    # minimal namespaced API server: objects in server.objects[path][name]
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        size = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(size).decode("utf-8"))
+
+    def _split(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path
+        # /api/v1/namespaces/NS/KIND or /apis/GROUP/VERSION/namespaces/NS/KIND
+        depth = 5 if path.startswith("/api/") else 6
+        if path.count("/") == depth:
+            return path, None, query
+        path, _, name = path.rpartition("/")
+        return path, name, query
+
+    def do_GET(self):
+        path, _, query = self._split()
+        items = list(self.server.objects.get(path, {}).values())
+        if "labelSelector" in query:
+            key, _, value = query["labelSelector"].partition("=")
+            items = [
+                item for item in items
+                if item["metadata"].get("labels", {}).get(key) == value
+            ]
+        if query.get("watch") == "true":
+            self.send_response(200)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for item in items:
+                self.wfile.write(json.dumps(
+                    {"type": "ADDED", "object": item}).encode("utf-8"))
+                self.wfile.write(b"\n")
+            self.close_connection = True
+            return
+        # no kind on the items, like the real API server
+        items = [
+            {key: value for key, value in item.items() if key != "kind"}
+            for item in items
+        ]
+        self._reply(200, {"kind": "List", "apiVersion": "v1", "items": items})
+
+    def do_POST(self):
+        path, _, _ = self._split()
+        obj = self._body()
+        objects = self.server.objects.setdefault(path, {})
+        name = obj["metadata"]["name"]
+        if name in objects or name.endswith("-1"):
+            self._reply(409, {"message": "%s already exists" % name})
+            return
+        objects[name] = obj
+        if self.server.lost_replies > 0:
+            self.server.lost_replies -= 1
+            self.close_connection = True
+            return
+        self._reply(201, obj)
+
+    def do_PATCH(self):
+        path, name, _ = self._split()
+        self.server.patches.append(
+            (self.headers["Content-Type"], name, self._body()))
+        self._reply(200, self.server.objects[path][name])
+
+    def do_DELETE(self):
+        path, name, _ = self._split()
+        self.server.deletes.append(self._body())
+        obj = self.server.objects.get(path, {}).pop(name, None)
+        if obj is None:
+            self._reply(404, {"message": "%s not found" % name})
+            return
+        self._reply(200, obj)
+
+
+@pytest.fixture
+def api_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeApiHandler)
+    server.objects = {}
+    server.patches = []
+    server.deletes = []
+    server.connections = 0
+    server.lost_replies = 0
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _api_cmd(server):
+    return mkkvenv.make_cmd("http://127.0.0.1:%d" % server.server_address[1])
+
+
+_VMS_PATH = "/apis/kubevirt.io/v1alpha2/namespaces/default/virtualmachines"
+_PODS_PATH = "/api/v1/namespaces/default/pods"
+
+
+def test_api_cmd_bulk(api_server):
+    cmd = _api_cmd(api_server)
+    assert isinstance(cmd, mkkvenv.ApiCmd)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+
+    done = mkkvenv.setup(cmd, vm_defs, bulk=True)
+    assert [vm_def.name for vm_def in done] == ["testvm-0", "testvm-2"]
+    assert sorted(vm.name for vm in cmd.get_vms()) == ["testvm-0", "testvm-2"]
+
+    assert cmd.start_many(done) == set(["testvm-0", "testvm-2"])
+    assert api_server.patches[0] == (
+        "application/json-patch+json", "testvm-0",
+        [{"op": "replace", "path": "/spec/running", "value": True}])
+
+    done = mkkvenv.teardown(cmd, vm_defs, bulk=True)
+    assert [vm_def.name for vm_def in done] == ["testvm-0", "testvm-2"]
+    assert cmd.get_vms() == []
+    assert api_server.deletes[0] == {"propagationPolicy": "Background"}
+    # all the requests on the same connection
+    assert api_server.connections == 1
+
+
+def test_api_cmd_vm_api(api_server):
+    master_def = dict(VM_MASTER_DEF, apiVersion="kubevirt.io/v1")
+    cmd = mkkvenv.make_cmd(
+        "http://127.0.0.1:%d" % api_server.server_address[1],
+        vm_api=master_def["apiVersion"])
+    vm_defs = mkkvenv.make_vm_defs(master_def, 1)
+    assert mkkvenv.setup(cmd, vm_defs, bulk=True) == vm_defs
+    assert [vm.name for vm in cmd.get_vms()] == ["testvm-0"]
+    assert cmd.start_many(vm_defs) == set(["testvm-0"])
+    assert list(api_server.objects) == [
+        "/apis/kubevirt.io/v1/namespaces/default/virtualmachines"]
+
+
+def test_api_cmd_apply(api_server):
+    cmd = _api_cmd(api_server)
+    pvc = mkkvenv.PVC.from_yaml(mkkvenv._PVC_TMPL.format(name="pvc-0", size=1))
+    cmd.add_pvc(pvc, "http://img", "disk.qcow2")
+    # already there: updated
+    cmd.add_pvc(pvc, "http://img", "disk.qcow2")
+    assert api_server.patches[0][:2] == (
+        "application/merge-patch+json", "pvc-0")
+    assert [pvc.name for pvc in cmd.get_pvcs()] == ["pvc-0"]
+    assert cmd.delete_pvcs(["pvc-0", "pvc-9"]) == set(["pvc-0"])
+
+
+def test_api_cmd_readiness(api_server):
+    api_server.objects[_PODS_PATH] = {
+        "virt-launcher-testvm-0": _pod_obj(
+            "virt-launcher-testvm-0", domain="testvm-0"),
+        "other": dict(_pod_obj("other"), metadata={"name": "other"}),
+    }
+    cmd = _api_cmd(api_server)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(2)]
+    assert cmd.readiness_status(vm_defs) == {"testvm-0": True}
+    assert cmd.get_ips(vm_defs) == {"testvm-0": "10.0.0.1"}
+
+
+def test_api_cmd_watch(api_server):
+    api_server.objects[_VMS_PATH] = {
+        "testvm-0": {"kind": "VirtualMachine",
+                     "metadata": {"name": "testvm-0"}},
+    }
+    cmd = _api_cmd(api_server)
+    watcher = cmd.watch_vms()
+    while watcher.alive:
+        watcher.wait_changed(1.0)
+    watcher.close()
+    assert [vm.name for vm in watcher.snapshot()] == ["testvm-0"]
+
+
+def test_api_cmd_create_reply_lost(api_server):
+    api_server.lost_replies = 1
+    cmd = _api_cmd(api_server)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, 0)]
+    done = mkkvenv.setup(cmd, vm_defs)
+    assert [vm_def.name for vm_def in done] == ["testvm-0"]
+    assert list(api_server.objects[_VMS_PATH]) == ["testvm-0"]
+
+
+def test_api_cmd_error(api_server):
+    cmd = _api_cmd(api_server)
+    with pytest.raises(RuntimeError):
+        cmd.delete(mkkvenv.VMDef(VM_MASTER_DEF, 0))
+
+
+def test_make_vm_defs_template():
+    vm_defs = mkkvenv.make_vm_defs(VM_MASTER_DEF, 3)
+    for ident, vm_def in enumerate(vm_defs):
+        expected = copy.deepcopy(VM_MASTER_DEF)
+        expected["metadata"]["name"] = "testvm-%d" % ident
+        volume = expected["spec"]["template"]["spec"]["volumes"][0]
+        volume["persistentVolumeClaim"]["claimName"] = "testpvc-%d" % ident
+        assert yaml.safe_load(vm_def.to_yaml()) == expected
+        assert vm_def.to_dict() == expected
+    assert VM_MASTER_DEF["metadata"]["name"] == "testvm"
+
+
+def test_make_vm_defs_shares_master():
+    master_def = copy.deepcopy(VM_MASTER_DEF)
+    master_def["spec"]["template"]["spec"]["volumes"].append(
+        {"name": "datavolume", "emptyDisk": {"capacity": "1Gi"}})
+    vm_def, = mkkvenv.make_vm_defs(master_def, 1)
+    master_volumes = master_def["spec"]["template"]["spec"]["volumes"]
+    volumes = vm_def.to_dict()["spec"]["template"]["spec"]["volumes"]
+    # only the root volume is copied
+    assert volumes[0] is not master_volumes[0]
+    assert volumes[1] is master_volumes[1]
+    assert master_volumes[0]["persistentVolumeClaim"]["claimName"] == "testpvc"
+
+
+def test_vm_template_quotes_names():
+    template = mkkvenv.VMTemplate(VM_MASTER_DEF)
+    obj = yaml.safe_load(template.render("1234", "0x10"))
+    assert obj["metadata"]["name"] == "1234"
+    volume = obj["spec"]["template"]["spec"]["volumes"][0]
+    assert volume["persistentVolumeClaim"]["claimName"] == "0x10"
+
+
+def test_backoff():
+    backoff = mkkvenv.Backoff(1.0, 0.5, 4.0, factor=2, jitter=0)
+    assert backoff.next(False, 1.0) == 2.0
+    assert backoff.next(False, 1.0) == 4.0
+    assert backoff.next(False, 1.0) == 4.0
+    assert backoff.next(True, 1.0) == 2.0
+    # almost done
+    assert backoff.next(False, 0.05) == 0.5
+
+
+def test_backoff_jitter():
+    backoff = mkkvenv.Backoff(1.0, 1.0, 1.0, jitter=0.2)
+    for _ in range(100):
+        assert 0.8 <= backoff.next(False, 1.0) <= 1.2
+
+
+class FakeSlowCmd:
+    # listing takes time, and the VMs are ready one at a time
+    def __init__(self, delay, ready_after):
+        self._delay = delay
+        self._ready_after = ready_after
+        self.calls = 0
+
+    def readiness_status(self, vm_defs, pods=None):
+        time.sleep(self._delay)
+        self.calls += 1
+        return {
+            vm_def.name: ident < self.calls - self._ready_after
+            for ident, vm_def in enumerate(vm_defs)
+        }
+
+
+def test_wait_ready_vm_deadline_counts_listing(monkeypatch):
+    monkeypatch.setattr(mkkvenv, '_pause', lambda watcher, step: step)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, 0)]
+    cmd = FakeSlowCmd(0.1, ready_after=1000)
+    begin = time.monotonic()
+    with pytest.raises(TimeoutError):
+        mkkvenv.wait_ready_vm(cmd, vm_defs, 0.3)
+    assert time.monotonic() - begin < 1.0
+
+
+def test_wait_ready_vm_time_to_ready(monkeypatch):
+    monkeypatch.setattr(mkkvenv, '_pause', lambda watcher, step: step)
+    vm_defs = [mkkvenv.VMDef(VM_MASTER_DEF, ident) for ident in range(3)]
+    cmd = FakeSlowCmd(0.01, ready_after=1)
+    ready_at = mkkvenv.wait_ready_vm(cmd, vm_defs, 10)
+    assert sorted(ready_at) == ["testvm-0", "testvm-1", "testvm-2"]
+    assert ready_at["testvm-0"] < ready_at["testvm-1"] < ready_at["testvm-2"]
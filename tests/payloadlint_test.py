@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# (C) 2018 Red Hat Inc.
+# License: Apache v2
+
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+import payloadlint
+
+
+def _make_payload(path, members):
+    with tarfile.open(path, mode='w:gz') as tar:
+        for name, data, mode in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_lint_ok(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, [('./payload.sh', b'#!/bin/sh\n', 0o755)])
+    assert payloadlint.lint(payload) == 0
+
+
+def test_lint_missing_entrypoint(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, [('./bench.sh', b'#!/bin/sh\n', 0o755)])
+    assert payloadlint.lint(payload) == -1
+
+
+def test_lint_stops_at_entrypoint(tmpdir):
+    payload = tmpdir.join('payload.tgz')
+    _make_payload(str(payload), [
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+        ('./data.bin', b'\0' * 1024 * 1024, 0o644),
+    ])
+    # the truncated tail is never read, unless scanning the whole payload
+    data = payload.read_binary()
+    payload.write_binary(data[:len(data) // 2])
+
+    assert payloadlint.lint(str(payload)) == 0
+    assert payloadlint.lint(str(payload), full_scan=True) == -1
+
+
+def _make_zstd_payload(tmpdir, members):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, members)
+    dst = str(tmpdir.join('payload.tar.zst'))
+    with open(dst, 'wb') as out:
+        subprocess.check_call(
+            'gzip -dc %s | zstd -q -c' % payload, shell=True, stdout=out)
+    return tmpdir.join('payload.tar.zst')
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='needs zstd')
+def test_lint_zstd(tmpdir):
+    payload = _make_zstd_payload(tmpdir, [
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+        ('./data.bin', b'\0' * 1024 * 1024, 0o644),
+    ])
+    assert payloadlint.lint(str(payload)) == 0
+    assert payloadlint.lint(str(payload), full_scan=True) == 0
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='needs zstd')
+def test_lint_zstd_corrupted(tmpdir):
+    payload = _make_zstd_payload(tmpdir, [
+        ('./data.bin', os.urandom(256 * 1024), 0o644),
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+    ])
+    data = payload.read_binary()
+    payload.write_binary(data[:len(data) // 2])
+    assert payloadlint.lint(str(payload), full_scan=True) == -1
+
+
+def test_scan_payload(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, [
+        ('./data/a.bin', b'a' * 10, 0o644),
+        ('./data/b.bin', b'b' * 30, 0o644),
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+        ('./data/c.bin', b'c' * 20, 0o644),
+    ])
+
+    with tarfile.open(payload, mode='r|gz') as tar:
+        scan = payloadlint.scan_payload(tar, top=2)
+
+    assert scan.members == 4
+    assert scan.size == 70
+    assert sorted(scan.largest, reverse=True) == [
+        (30, './data/b.bin'), (20, './data/c.bin')]
+    assert scan.entrypoint.name == './payload.sh'
+
+
+def test_lint_not_executable(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, [('./payload.sh', b'#!/bin/sh\n', 0o644)])
+    assert payloadlint.lint(payload) == -1
+
+
+@pytest.mark.parametrize('name,linkname,issue', [
+    ('/etc/passwd', None, 'overwrites system path'),
+    ('/opt/data', None, 'absolute path'),
+    ('../data', None, 'outside the root'),
+    ('data/../../data', None, 'outside the root'),
+    ('data', '../../etc', 'symlink outside the root'),
+    ('data', '/etc/passwd', 'symlink outside the root'),
+])
+def test_path_issues(name, linkname, issue):
+    info = tarfile.TarInfo(name)
+    if linkname is not None:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+    assert issue in payloadlint.path_issues(info)
+
+
+def test_path_issues_none():
+    info = tarfile.TarInfo('./data/../payload.sh')
+    assert payloadlint.path_issues(info) == []
+
+
+def test_lint_deep_unsafe(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    _make_payload(payload, [
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+        ('../escape', b'', 0o644),
+    ])
+    assert payloadlint.lint(payload) == 0
+    assert payloadlint.lint(payload, deep=True) == -1
+
+
+def test_lint_manifest(tmpdir):
+    payload = str(tmpdir.join('payload.tgz'))
+    manifest = tmpdir.join('manifest.json')
+    _make_payload(payload, [
+        ('./payload.sh', b'#!/bin/sh\n', 0o755),
+        ('./data.txt', b'hello', 0o644),
+    ])
+
+    assert payloadlint.lint(payload, deep=True, manifest=str(manifest)) == 0
+
+    content = json.loads(manifest.read())
+    assert content['payload'] == 'payload.tgz'
+    assert content['files'] == [{
+        'name': 'payload.sh', 'type': 'file', 'size': 10, 'mode': '0755',
+        'sha256': hashlib.sha256(b'#!/bin/sh\n').hexdigest(),
+    }, {
+        'name': 'data.txt', 'type': 'file', 'size': 5, 'mode': '0644',
+        'sha256': hashlib.sha256(b'hello').hexdigest(),
+    }]
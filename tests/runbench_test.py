@@ -4,8 +4,14 @@
 
 
 from collections import namedtuple
+import argparse
+import hashlib
+import json
 import os.path
+import subprocess
+import time
 
+import gevent
 import pytest
 
 import runbench
@@ -22,6 +28,32 @@ def test_check_auth_ok():
     assert auth == runbench.check_auth(auth)
 
 
+@pytest.mark.parametrize('auth', [
+    ({
+        "user": "root",
+        "method": "key",
+        "details": {
+            "private_key": "~/.ssh/id_rsa",
+        }
+    }),
+    ({
+        "user": "root",
+        "method": "key",
+        "details": {
+            "private_key": "~/.ssh/id_rsa",
+            "passphrase": "unsafe",
+        }
+    }),
+    ({
+        "user": "root",
+        "method": "agent",
+        "details": {}
+    }),
+])
+def test_check_auth_key_agent_ok(auth):
+    assert auth == runbench.check_auth(auth)
+
+
 @pytest.mark.parametrize('auth', [
     ({}),
     ({
@@ -44,12 +76,53 @@ def test_check_auth_ok():
             "foo": "bar",
         }
     }),
+    ({
+        "user": "root",
+        "method": "key",
+        "details": {
+            "passphrase": "unsafe",
+        }
+    }),
+    ({
+        "user": "root",
+        "method": "kerberos",
+        "details": {}
+    }),
 ])
 def test_check_auth_malformed(auth):
     with pytest.raises(ValueError):
         runbench.check_auth(auth)
 
 
+def test_auth_params_key():
+    auth = {
+        "user": "root",
+        "method": "key",
+        "details": {
+            "private_key": "/etc/benchkit/id_rsa",
+            "passphrase": "unsafe",
+        }
+    }
+    assert runbench._auth_params(auth) == {
+        "user": "root",
+        "pkey": "/etc/benchkit/id_rsa",
+        "password": "unsafe",
+        "allow_agent": False,
+    }
+
+
+def test_auth_params_agent():
+    auth = {
+        "user": "root",
+        "method": "agent",
+        "details": {}
+    }
+    assert runbench._auth_params(auth) == {
+        "user": "root",
+        "allow_agent": True,
+    }
+
+
 def test_read_hosts_ok():
     assert runbench.read_hosts("/etc/hosts")
 
@@ -70,7 +143,18 @@ FakeHostOutput = namedtuple(
     'FakeHostOutput', ['exit_code', 'stdout', 'stderr'])
 
 
-def test_process_output_ok(tmpdir):
+def _collect(output, basepath, stream='none', min_success=None,
+             results=None):
+    # runs the payload collection, the payload already completed
+    args = argparse.Namespace(
+        bench_id=basepath, stream=stream, root="/tmp/bk",
+        min_success=min_success, run_timeout=0, straggler_quantile=1.0,
+        straggler_grace=0)
+    return runbench.collect_output(
+        output, args, lambda host, host_output: None, {}, results=results)
+
+
+def test_collect_output_ok(tmpdir):
     output = {
             "foobar": FakeHostOutput(
                 exit_code=0,
@@ -79,7 +163,7 @@ def test_process_output_ok(tmpdir):
             ),
     }
     basepath = os.path.join(tmpdir, "test")
-    runbench.process_output(output, basepath)
+    assert _collect(output, basepath) == 0
     with open(basepath + "-result") as f:
         data = f.read()
     assert data == """### foobar
@@ -87,7 +171,7 @@ everything OK
 """
 
 
-def test_process_output_failed(tmpdir):
+def test_collect_output_failed(tmpdir):
     output = {
             "foobar": FakeHostOutput(
                 exit_code=2,
@@ -96,9 +180,820 @@ def test_process_output_failed(tmpdir):
             ),
     }
     basepath = os.path.join(tmpdir, "test")
-    runbench.process_output(output, basepath)
+    assert _collect(output, basepath) == -1
     with open(basepath + "-errors") as f:
         data = f.read()
-    assert data == """### foobar
+    assert data == """### foobar (exit code 2)
 test failed
 """
+
+
+def test_collect_output_partial(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK too"],
+                stderr=[]
+            ),
+            "baz": FakeHostOutput(
+                exit_code=1,
+                stdout=[],
+                stderr=["test failed"]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    assert _collect(output, basepath) == -1
+    assert _collect(output, basepath, min_success="2") == 0
+    assert _collect(output, basepath, min_success="66%") == 0
+    assert _collect(output, basepath, min_success="67%") == -1
+    with open(basepath + "-result") as f:
+        data = f.read()
+    assert data == """### foo
+everything OK
+### bar
+everything OK too
+"""
+    with open(basepath + "-errors") as f:
+        data = f.read()
+    assert data == """### baz (exit code 1)
+test failed
+"""
+
+
+@pytest.mark.parametrize('spec,total,expected', [
+    (None, 300, 300),
+    ("298", 300, 298),
+    ("99%", 300, 297),
+    ("99.5%", 300, 299),
+    ("100%", 300, 300),
+])
+def test_min_success_count(spec, total, expected):
+    assert runbench.min_success_count(spec, total) == expected
+
+
+@pytest.mark.parametrize('spec', ["0", "298", "99.5%", "100%"])
+def test_min_success_spec(spec):
+    assert runbench.min_success_spec(spec) == spec
+
+
+@pytest.mark.parametrize('spec', ["", "-1", "1.5", "abc", "101%", "%"])
+def test_min_success_spec_malformed(spec):
+    with pytest.raises(argparse.ArgumentTypeError):
+        runbench.min_success_spec(spec)
+
+
+def test_collect_output_stream_host(tmpdir):
+    output = {
+            "foobar": FakeHostOutput(
+                exit_code=0,
+                stdout=["line 1", "line 2"],
+                stderr=["warning"]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    assert _collect(output, basepath, "host") == 0
+    with open(basepath + "-result-foobar") as f:
+        assert f.read() == "line 1\nline 2\n"
+    with open(basepath + "-errors-foobar") as f:
+        assert f.read() == "warning\n"
+
+
+def _interleaved(lines):
+    for line in lines:
+        gevent.sleep(0)
+        yield line
+
+
+def test_collect_output_stream_host_max_open(tmpdir, monkeypatch):
+    monkeypatch.setattr(runbench, '_MAX_STREAM_FILES', 1)
+    output = {
+            host: FakeHostOutput(
+                exit_code=0,
+                stdout=_interleaved(["%s 1" % host, "%s 2" % host]),
+                stderr=_interleaved(["%s warning" % host])
+            )
+            for host in ("foo", "bar", "baz")
+    }
+    basepath = os.path.join(tmpdir, "test")
+    assert _collect(output, basepath, "host") == 0
+    for host in output:
+        with open(basepath + "-result-" + host) as f:
+            assert f.read() == "%s 1\n%s 2\n" % (host, host)
+        with open(basepath + "-errors-" + host) as f:
+            assert f.read() == "%s warning\n" % host
+
+
+def test_collect_output_stream_failed(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=1,
+                stdout=[],
+                stderr=["test failed"]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    assert _collect(output, basepath, "host") == -1
+    with open(basepath + "-errors") as f:
+        assert f.read() == "### bar (exit code 1)\n"
+    with open(basepath + "-errors-bar") as f:
+        assert f.read() == "test failed\n"
+    assert not os.path.exists(basepath + "-result")
+
+
+def test_collect_output_stream_tagged(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=1,
+                stdout=[],
+                stderr=["test failed"]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    assert _collect(output, basepath, "tagged") == -1
+    with open(basepath + "-stream") as f:
+        lines = sorted(f.read().splitlines())
+    assert lines == ["[bar!] test failed", "[foo] everything OK"]
+
+
+@pytest.mark.parametrize('have,missing,fanout,hops,left', [
+    (["a"], ["b", "c", "d"], 1, [("a", "b")], ["c", "d"]),
+    (["a", "b"], ["c", "d", "e"], 1, [("a", "c"), ("b", "d")], ["e"]),
+    (["a"], ["b", "c", "d"], 2, [("a", "b"), ("a", "c")], ["d"]),
+    (["a", "b"], ["c"], 2, [("a", "c")], []),
+])
+def test_next_hops(have, missing, fanout, hops, left):
+    assert runbench.next_hops(have, missing, fanout) == (hops, left)
+
+
+def test_next_hops_rounds():
+    have, missing = ["seed"], ["vm-%d" % i for i in range(127)]
+    rounds = 0
+    while missing:
+        hops, missing = runbench.next_hops(have, missing, 1)
+        have.extend(dst for _, dst in hops)
+        rounds += 1
+    assert rounds == 7
+
+
+class FakeClient:
+    def __init__(self, hosts, output=None):
+        self.hosts = hosts
+        self.output = output
+        self.commands = []
+
+    def run_command(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        return {
+            host: self.output[host] for host in self.hosts
+        }
+
+    def join(self, output, timeout=None):
+        pass
+
+
+def test_restricted():
+    client = FakeClient(["a", "b", "c"])
+    with runbench.restricted(client, ["b"]):
+        assert client.hosts == ["b"]
+    assert client.hosts == ["a", "b", "c"]
+
+
+class FakeSlowClient(FakeClient):
+    def join(self, output, timeout=None):
+        raise runbench.Timeout()
+
+
+def test_relay_payload_timeout():
+    output = {
+        "b": FakeHostOutput(exit_code=0, stdout=["2000000000"], stderr=[]),
+        "c": FakeHostOutput(exit_code=None, stdout=[], stderr=[]),
+        "d": FakeHostOutput(exit_code=1, stdout=[], stderr=[]),
+    }
+    client = FakeSlowClient(["a", "b", "c", "d"], output)
+    hops = [("a", "b"), ("a", "c"), ("b", "d")]
+    done = runbench.relay_payload(client, "root", hops, "/tmp/bk/p.tgz", 5)
+    assert done == {"b": 2.}
+    assert client.hosts == ["a", "b", "c", "d"]
+
+
+def test_payload_digest(tmpdir):
+    path = os.path.join(tmpdir, "payload.tgz")
+    with open(path, "wb") as f:
+        f.write(b"benchkit")
+    digest = hashlib.sha256(b"benchkit").hexdigest()
+    assert runbench.payload_digest(path, chunk_size=3) == digest
+
+
+def test_find_uncached():
+    output = {
+        "a": FakeHostOutput(exit_code=0, stdout=["0123abcd"], stderr=[]),
+        "b": FakeHostOutput(exit_code=0, stdout=["deadbeef"], stderr=[]),
+        "c": FakeHostOutput(exit_code=0, stdout=[], stderr=[]),
+    }
+    client = FakeClient(["a", "b", "c"], output)
+    assert runbench.find_uncached(client, "/tmp/bk", "0123abcd", 10) == [
+        "b", "c"
+    ]
+    assert len(client.commands) == 1
+
+
+class FakeHostClient:
+    def __init__(self, host, results):
+        # results: command prefix -> (exit_code, stdout)
+        self.host = host
+        self.results = results
+        self.commands = []
+        self.copied = []
+
+    def _result(self, cmd):
+        for prefix, result in self.results.items():
+            if cmd.startswith(prefix):
+                return result
+        return (0, [])
+
+    def run_command(self, cmd):
+        self.commands.append(cmd)
+        exit_code, stdout = self._result(cmd)
+        return (cmd, self.host, iter(stdout), iter([]), None)
+
+    def wait_finished(self, channel):
+        pass
+
+    def get_exit_status(self, channel):
+        return self._result(channel)[0]
+
+    def copy_file(self, src, dst):
+        self.copied.append((src, dst))
+
+
+def _pipeline_args(**kwargs):
+    args = dict(root="/tmp/bk", payload="/srv/payload.tgz", timeout=10,
+                no_cache=False, manifest_sums=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_pipeline_host_upload():
+    host_client = FakeHostClient("a", {"cd ": (0, ["result"])})
+    barrier = runbench.Barrier(1)
+    host_output = runbench.pipeline_host(
+        host_client, _pipeline_args(), "0123abcd", barrier)
+    assert host_client.copied == [
+        ("/srv/payload.tgz", "/tmp/bk/payload.tgz")
+    ]
+    host_output.join()
+    assert host_output.exit_code == 0
+    assert list(host_output.stdout) == ["result"]
+
+
+def test_pipeline_host_cached():
+    host_client = FakeHostClient("a", {"/usr/bin/cat": (0, ["0123abcd"])})
+    runbench.pipeline_host(host_client, _pipeline_args(), "0123abcd")
+    assert host_client.copied == []
+    assert not any("tar" in cmd for cmd in host_client.commands)
+
+
+def test_pipeline_host_failed():
+    host_client = FakeHostClient("a", {"/usr/bin/mkdir": (1, [])})
+    barrier = runbench.Barrier(2)
+    host_output = runbench.pipeline_host(
+        host_client, _pipeline_args(), "0123abcd", barrier)
+    assert host_output.exit_code == -1
+    # the other host does not wait for the failed one
+    with gevent.Timeout(1):
+        barrier.wait()
+
+
+class FakeSlowHostClient(FakeHostClient):
+    def __init__(self, host, results, copy_delay=0, cmd_delays=None):
+        super().__init__(host, results)
+        self.copy_delay = copy_delay
+        self.cmd_delays = cmd_delays or {}
+
+    def wait_finished(self, channel):
+        for prefix, delay in self.cmd_delays.items():
+            if channel.startswith(prefix):
+                gevent.sleep(delay)
+
+    def copy_file(self, src, dst):
+        gevent.sleep(self.copy_delay)
+        super().copy_file(src, dst)
+
+
+def test_pipeline_host_slow_upload():
+    host_client = FakeSlowHostClient("a", {}, copy_delay=0.2)
+    host_output = runbench.pipeline_host(
+        host_client, _pipeline_args(timeout=0.05), "0123abcd")
+    assert host_output.exit_code is None
+    assert host_client.copied == [
+        ("/srv/payload.tgz", "/tmp/bk/payload.tgz")
+    ]
+
+
+def test_pipeline_host_slow_command():
+    host_client = FakeSlowHostClient(
+        "a", {}, cmd_delays={"/usr/bin/mkdir": 0.2})
+    host_output = runbench.pipeline_host(
+        host_client, _pipeline_args(timeout=0.05), "0123abcd")
+    assert host_output.exit_code == -1
+    assert host_client.copied == []
+
+
+def test_sync_start_measure():
+    now = time.time()
+    host_client = FakeHostClient(
+        "a", {"/usr/bin/date": (0, ["%.6f" % (now + 100)])})
+    sync = runbench.SyncStart(5)
+    sync.measure(host_client)
+    offset, rtt = sync.clocks["a"]
+    assert abs(offset - 100) < 1
+    assert rtt >= 0
+
+
+def test_sync_start_skews(tmpdir):
+    sync = runbench.SyncStart(5)
+    sync.clocks = {"a": (100., 0.01), "b": (-2., 0.01), "c": (0., 0.01)}
+    start_at = sync.release()
+    assert sync.remote_start_at("a") == start_at + 100.
+    started = {
+        "a": start_at + 100.5,
+        "b": start_at - 2.,
+        "c": None,
+    }
+    skews = sync.skews(started)
+    assert skews == {"a": pytest.approx(0.5), "b": pytest.approx(0.)}
+
+    name = os.path.join(tmpdir, "test-sync")
+    runbench.write_sync_report(name, sync, started)
+    with open(name) as f:
+        data = f.read()
+    assert "### c\noffset=+0.000000 rtt=0.010000 skew=unknown\n" in data
+
+
+def test_payload_cmd_start_at():
+    cmd = runbench._payload_cmd("/tmp/bk", 1538388000.5)
+    assert "BENCH_START_AT=1538388000.500000" in cmd
+    assert "BENCH_ROOT=/tmp/bk" in cmd
+
+
+def test_collect_output_json_results(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything", "OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=2,
+                stdout=[],
+                stderr=["test failed"]
+            ),
+    }
+    timings = runbench.Timings()
+    timings.record("foo", "mkdir", 10., 11.)
+    timings.record("foo", "run", 12., 15.5)
+    timings.record("bar", "run", 12., None)
+    basepath = os.path.join(tmpdir, "test")
+    results = runbench.Results(
+        basepath + "-results.jsonl", "test", "0123abcd", timings)
+    _collect(output, basepath, results=results)
+    results.close()
+
+    with open(basepath + "-results.jsonl") as f:
+        records = {
+            record["host"]: record
+            for record in (json.loads(line) for line in f)
+        }
+    assert records["foo"] == {
+        "bench_id": "test",
+        "host": "foo",
+        "payload_digest": "0123abcd",
+        "exit_code": 0,
+        "stdout": "everything\nOK",
+        "stderr": "",
+        "timed_out": False,
+        "clock_offset": None,
+        "start_skew": None,
+        "start": 10.,
+        "end": 15.5,
+        "stages": {"mkdir": 1., "run": 3.5},
+    }
+    assert records["bar"]["exit_code"] == 2
+    assert records["bar"]["stderr"] == "test failed"
+    assert records["bar"]["stages"] == {}
+
+
+@pytest.mark.parametrize('values,pct,expected', [
+    ([1.], 50, 1.),
+    ([3., 1., 2.], 50, 2.),
+    ([float(x) for x in range(1, 101)], 95, 95.),
+    ([float(x) for x in range(1, 101)], 100, 100.),
+])
+def test_percentile(values, pct, expected):
+    assert runbench.percentile(values, pct) == expected
+
+
+def test_timings_trace(tmpdir):
+    timings = runbench.Timings()
+    timings.record("a", "upload", 10., 12.5)
+    timings.record("a", "run", 13., None)
+    timings.record("b", "upload", 10., 11.)
+    assert timings.durations() == {"upload": [2.5, 1.]}
+
+    path = os.path.join(tmpdir, "trace.json")
+    runbench.write_trace(path, timings)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    spans = [ev for ev in events if ev["ph"] == "X"]
+    assert spans == [
+        {
+            "name": "upload", "cat": "runbench", "ph": "X", "pid": 1,
+            "tid": 1, "ts": 10000000, "dur": 2500000,
+            "args": {"host": "a"},
+        },
+        {
+            "name": "upload", "cat": "runbench", "ph": "X", "pid": 1,
+            "tid": 2, "ts": 10000000, "dur": 1000000,
+            "args": {"host": "b"},
+        },
+    ]
+
+
+def test_wait_hosts():
+    waited = []
+
+    def wait(host, host_output):
+        gevent.sleep(0.01 if host == "slow" else 0)
+        waited.append(host)
+
+    ends = runbench.wait_hosts({"slow": None, "fast": None}, wait)
+    assert waited == ["fast", "slow"]
+    assert ends["fast"] <= ends["slow"]
+
+
+def _fake_wait(delays):
+    def wait(host, host_output):
+        gevent.sleep(delays[host])
+    return wait
+
+
+def test_wait_stragglers_quantile():
+    output = {"a": None, "b": None, "c": None, "d": None}
+    done = []
+    stragglers = runbench.wait_stragglers(
+        output, _fake_wait({"a": 0, "b": 0, "c": 0.05, "d": 10}),
+        lambda host, host_output, end: done.append(host),
+        quantile=0.5, grace=0.2)
+    assert sorted(done) == ["a", "b", "c"]
+    assert stragglers == ["d"]
+
+
+def test_wait_stragglers_timeout():
+    output = {"a": None, "b": None}
+    done = []
+    stragglers = runbench.wait_stragglers(
+        output, _fake_wait({"a": 0, "b": 10}),
+        lambda host, host_output, end: done.append(host),
+        timeout=0.1)
+    assert done == ["a"]
+    assert stragglers == ["b"]
+
+
+def _hang():
+    yield "partial"
+    gevent.sleep(10)
+    yield "never"
+
+
+def test_collect_output_timeout(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=None,
+                stdout=_hang(),
+                stderr=[]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    args = argparse.Namespace(
+        bench_id=basepath, stream="none", root="/tmp/bk", min_success=None,
+        run_timeout=1, straggler_quantile=0.5, straggler_grace=0)
+    ret = runbench.collect_output(
+        output, args, lambda host, host_output: None, {})
+    assert ret == -1
+    with open(basepath + "-result") as f:
+        assert f.read() == "### foo\neverything OK\n"
+    with open(basepath + "-errors") as f:
+        assert f.read() == (
+            "### bar (timed out)\nbenchkit: timed out, output is partial\n")
+
+
+def test_collect_output_sync(tmpdir):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+    }
+    sync = runbench.SyncStart(5)
+    sync.clocks = {"foo": (100., 0.01)}
+    start_at = sync.release()
+    host_clients = {
+        "foo": FakeHostClient(
+            "foo", {"/usr/bin/cat": (0, ["%.6f" % (start_at + 100.25)])}),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    args = argparse.Namespace(
+        bench_id=basepath, stream="none", root="/tmp/bk", min_success=None,
+        run_timeout=0, straggler_quantile=1.0, straggler_grace=0)
+    timings = runbench.Timings()
+    results = runbench.Results(
+        basepath + "-results.jsonl", "test", "0123abcd", timings)
+    ret = runbench.collect_output(
+        output, args, lambda host, host_output: None, host_clients,
+        timings, results, sync)
+    results.close()
+    assert ret == 0
+
+    with open(basepath + "-results.jsonl") as f:
+        record = json.loads(f.read())
+    assert record["clock_offset"] == 100.
+    assert record["start_skew"] == pytest.approx(0.25, abs=1e-5)
+    with open(basepath + "-sync") as f:
+        assert f.read().startswith("### foo\noffset=+100.000000")
+
+
+def test_load_sweep(tmpdir):
+    path = os.path.join(tmpdir, "sweep.yaml")
+    with open(path, "wt") as f:
+        f.write("THREADS: [1, 4]\nBLOCK_SIZE: [4k, 64k]\n")
+    assert runbench.load_sweep(path) == [
+        {"BLOCK_SIZE": "4k", "THREADS": 1},
+        {"BLOCK_SIZE": "4k", "THREADS": 4},
+        {"BLOCK_SIZE": "64k", "THREADS": 1},
+        {"BLOCK_SIZE": "64k", "THREADS": 4},
+    ]
+
+
+@pytest.mark.parametrize('content', [
+    "[1, 2]\n",
+    "THREADS: 4\n",
+    "not-a-name: [1, 2]\n",
+])
+def test_load_sweep_malformed(tmpdir, content):
+    path = os.path.join(tmpdir, "sweep.yaml")
+    with open(path, "wt") as f:
+        f.write(content)
+    with pytest.raises(ValueError):
+        runbench.load_sweep(path)
+
+
+def test_iteration_key():
+    params = {"THREADS": 4, "BLOCK_SIZE": "4k"}
+    assert runbench.iteration_key(params, 2) == "r2-BLOCK_SIZE=4k-THREADS=4"
+    assert runbench.iteration_key({}, 0) == "r0"
+
+
+def test_payload_cmd_env():
+    cmd = runbench._payload_cmd(
+        "/tmp/bk", env={"THREADS": 4, "NAME": "a b"})
+    assert cmd == (
+        "cd /tmp/bk && /usr/bin/setsid -w"
+        " /usr/bin/env BENCH_ROOT=/tmp/bk NAME='a b' THREADS=4"
+        " /bin/sh -c 'echo $$ > \"$BENCH_ROOT\"/.benchkit-pgid"
+        " && exec \"$BENCH_ROOT\"/payload.sh'"
+    )
+
+
+def test_cached_zstd(tmpdir, monkeypatch):
+    src = os.path.join(tmpdir, "payload.tgz")
+    subprocess.check_call(
+        ["tar", "czf", src, "-C", os.path.dirname(__file__), "."])
+    cache_dir = os.path.join(tmpdir, "cache")
+    dst = runbench.cached_zstd(src, "0123abcd", cache_dir)
+    assert dst == os.path.join(cache_dir, "0123abcd", "payload.tar.zst")
+    assert os.listdir(os.path.dirname(dst)) == ["payload.tar.zst"]
+    subprocess.check_call(["zstd", "-q", "-t", dst])
+
+    def _fail(src_path, dst_dir):
+        raise AssertionError("recompressed again")
+    monkeypatch.setattr(runbench, "recompress_zstd", _fail)
+    assert runbench.cached_zstd(src, "0123abcd", cache_dir) == dst
+
+
+def test_kill_cmd_process_group(tmpdir):
+    # the payload and the processes it started are all stopped
+    root = str(tmpdir)
+    path = os.path.join(root, "payload.sh")
+    with open(path, "wt") as f:
+        f.write("#!/bin/sh\nsleep 60 &\necho $! > child\nwait\n")
+    os.chmod(path, 0o755)
+    proc = subprocess.Popen(runbench._payload_cmd(root), shell=True)
+    child = os.path.join(root, "child")
+    deadline = time.monotonic() + 10
+    while not os.path.exists(child) or not open(child).read().strip():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    with open(child) as f:
+        child_pid = int(f.read())
+
+    assert runbench._kill_cmd(root).startswith("/usr/bin/pkill -g ")
+    subprocess.check_call(runbench._kill_cmd(root), shell=True)
+    assert proc.wait(10) != 0
+    deadline = time.monotonic() + 10
+    while _running(child_pid):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def _running(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_session_pool_connect():
+    output = {
+        "a": FakeHostOutput(exit_code=0, stdout=[], stderr=[]),
+        "b": FakeHostOutput(exit_code=None, stdout=[], stderr=[]),
+        "c": FakeHostOutput(exit_code=0, stdout=[], stderr=[]),
+    }
+    client = FakeClient(["a", "b", "c"], output)
+    pool = runbench.SessionPool(client)
+    assert pool.connect(10) == ["a", "c"]
+    assert pool.hosts == ["a", "c"]
+    assert client.commands == ["/usr/bin/true"] * 3
+    assert pool.unreachable == {"b": "exit code None"}
+
+
+def test_session_pool_connect_timings():
+    output = {
+        host: FakeHostOutput(exit_code=0, stdout=[], stderr=[])
+        for host in ("a", "b")
+    }
+    timings = runbench.Timings()
+    pool = runbench.SessionPool(FakeClient(["a", "b"], output))
+    assert pool.connect(10, timings) == ["a", "b"]
+    # one probe, thus one connection, per host
+    for host in ("a", "b"):
+        assert list(timings.stages(host)) == ["connect"]
+    assert len(timings.durations()["connect"]) == 2
+
+
+@pytest.mark.parametrize('min_success,expected', [
+    (None, -1),
+    ("2", 0),
+    ("100%", -1),
+])
+def test_collect_output_unreachable(tmpdir, min_success, expected):
+    output = {
+            "foo": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK"],
+                stderr=[]
+            ),
+            "bar": FakeHostOutput(
+                exit_code=0,
+                stdout=["everything OK too"],
+                stderr=[]
+            ),
+    }
+    basepath = os.path.join(tmpdir, "test")
+    args = argparse.Namespace(
+        bench_id=basepath, stream="none", root="/tmp/bk",
+        min_success=min_success, run_timeout=0, straggler_quantile=1.0,
+        straggler_grace=0)
+    timings = runbench.Timings()
+    results = runbench.Results(
+        basepath + "-results.jsonl", "test", "0123abcd", timings)
+    ret = runbench.collect_output(
+        output, args, lambda host, host_output: None, {}, timings, results,
+        unreachable={"baz": "connection refused"})
+    results.close()
+    assert ret == expected
+    with open(basepath + "-errors") as f:
+        assert f.read() == "### baz (unreachable)\nconnection refused\n"
+    with open(basepath + "-results.jsonl") as f:
+        records = {
+            record["host"]: record
+            for record in (json.loads(line) for line in f)
+        }
+    assert records["baz"]["exit_code"] is None
+    assert records["baz"]["stderr"] == "connection refused"
+
+
+def test_split_payload(tmpdir):
+    data = os.urandom(2500)
+    src = tmpdir.join('payload.tgz')
+    src.write_binary(data)
+    dst = tmpdir.mkdir('chunks')
+
+    chunks = runbench.split_payload(str(src), str(dst), 1000)
+
+    assert [name for name, _ in chunks] == ['000000', '000001', '000002']
+    for index, (name, digest) in enumerate(chunks):
+        part = dst.join(name).read_binary()
+        assert part == data[index * 1000:(index + 1) * 1000]
+        assert digest == hashlib.sha256(part).hexdigest()
+
+
+def test_check_chunks_cmd(tmpdir):
+    src = tmpdir.join('payload.tgz')
+    src.write_binary(os.urandom(3000))
+    chunks = runbench.split_payload(str(src), str(tmpdir), 1000)
+    chunk_dir = tmpdir.join('remote')
+    chunk_dir.mkdir()
+    # 000001 is missing, 000002 is corrupted
+    tmpdir.join('000000').copy(chunk_dir.join('000000'))
+    chunk_dir.join('000002').write_binary(b'garbage')
+
+    out = subprocess.check_output(
+        runbench._check_chunks_cmd(str(chunk_dir), chunks), shell=True)
+
+    assert runbench.verified_chunks(
+        out.decode('utf-8').splitlines()) == set(['000000'])
+
+
+def test_join_chunks_cmd(tmpdir):
+    src = tmpdir.join('payload.tgz')
+    src.write_binary(os.urandom(3000))
+    chunk_dir = tmpdir.mkdir('chunks')
+    chunks = runbench.split_payload(str(src), str(chunk_dir), 1000)
+    dst = tmpdir.join('joined.tgz')
+
+    subprocess.check_call(runbench._join_chunks_cmd(
+        str(chunk_dir), chunks, str(dst),
+        runbench.payload_digest(str(src))), shell=True)
+
+    assert dst.read_binary() == src.read_binary()
+    assert not chunk_dir.check()
+
+
+@pytest.mark.parametrize('payload,flags', [
+    ('/tmp/benchkit/payload.tgz', ' xz '),
+    ('/tmp/benchkit/payload.tar.zst', ' -x --use-compress-program='),
+])
+def test_unpack_cmd_compression(payload, flags):
+    cmd = runbench._unpack_cmd('/tmp/benchkit', payload, 'abc')
+    assert '/usr/bin/tar' + flags in cmd
+
+
+def test_load_manifest(tmpdir):
+    manifest = tmpdir.join('manifest.json')
+    manifest.write(json.dumps({"files": [
+        {"name": "data", "type": "dir", "size": 0, "mode": "0755"},
+        {"name": "payload.sh", "type": "file", "size": 10, "mode": "0755",
+         "sha256": "abcd"},
+    ]}))
+    assert runbench.load_manifest(str(manifest)) == [("abcd", "payload.sh")]
+
+
+def test_load_manifest_malformed(tmpdir):
+    manifest = tmpdir.join('manifest.json')
+    manifest.write(json.dumps({"files": [{"name": "payload.sh"}]}))
+    with pytest.raises(ValueError):
+        runbench.load_manifest(str(manifest))
+
+
+def test_verify_cmd(tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('payload.sh').write('#!/bin/sh\n')
+    digest = hashlib.sha256(b'#!/bin/sh\n').hexdigest()
+    runbench.write_manifest_sums(
+        str(root.join(runbench._MANIFEST_SUMS)), [(digest, 'payload.sh')])
+    assert subprocess.call(runbench._verify_cmd(str(root)), shell=True) == 0
+
+    root.join('payload.sh').write('#!/bin/bash\n')
+    assert subprocess.call(runbench._verify_cmd(str(root)), shell=True) != 0
+
+
+def test_pipeline_host_verify():
+    host_client = FakeHostClient("a", {"cd ": (0, [])})
+    host_output = runbench.pipeline_host(
+        host_client, _pipeline_args(manifest_sums="/tmp/sums"), "0123abcd")
+    assert ("/tmp/sums", "/tmp/bk/.benchkit-manifest") in host_client.copied
+    assert any("sha256sum -c" in cmd for cmd in host_client.commands)
+    host_output.join()
+    assert host_output.exit_code == 0